@@ -1,97 +1,503 @@
 import torch
 import torch.nn.functional as F
 import numpy as np
-from replay_buffer import ReplayBuffer
+from replay_buffer import PersistentReplayBuffer, ReplayBuffer
 import copy
-from mcts import search
+import queue
+import threading
+import time
+from collections import OrderedDict
+from mcts import TREE_BACKENDS, gumbel_search, random_rollouts, search, search_lockstep
 
 
 class ClassicMCTSAgent:
-  @staticmethod
-  def value_fn(game):
-    game = copy.deepcopy(game)
-    while first_person_result := game.get_first_person_result() is None:
-      game.step(np.random.choice(game.get_legal_actions()))
-    return first_person_result
+  def __init__(self, rollouts=1):
+    # the value of a position is the mean result of this many random rollouts
+    self.rollouts = rollouts
 
-  @staticmethod
-  def policy_fn(game):
+  def value_fn(self, game):
+    return random_rollouts(game, self.rollouts)
+
+  def policy_fn(self, game):
     return np.ones(game.action_space) / game.action_space
 
 
+class EvaluationCache:
+  # LRU cache of the (policy, value) evaluations keyed by the observation bytes. It empties itself as soon as the
+  # weights of the model change: torch bumps the version of a tensor on every in-place update, which is how both
+  # optimizer.step() and load_state_dict() change the parameters
+  def __init__(self, model, max_size=100_000):
+    self.model = model
+    self.max_size = max_size
+    self.entries = OrderedDict()
+    self.weights_version = None
+    self.hits = 0
+    self.misses = 0
+
+  def __len__(self):
+    return len(self.entries)
+
+  @property
+  def hit_rate(self):
+    return self.hits / max(self.hits + self.misses, 1)
+
+  def clear(self):
+    self.entries.clear()
+
+  def check_weights(self):
+    weights_version = sum(parameter._version for parameter in self.model.parameters())
+    if weights_version != self.weights_version:
+      self.entries.clear()
+      self.weights_version = weights_version
+
+  def get(self, key):
+    entry = self.entries.get(key)
+    if entry is None:
+      self.misses += 1
+    else:
+      self.hits += 1
+      self.entries.move_to_end(key)
+    return entry
+
+  def put(self, key, policy, value):
+    self.entries[key] = (policy, value)
+    if len(self.entries) > self.max_size:
+      self.entries.popitem(last=False)
+
+
 class AlphaZeroAgent:
-  def __init__(self, model):
+  def __init__(self, model, cache_size=0, symmetries=None):
     self.model = model
+    # positions repeat a lot across moves and games, so their evaluations can be cached
+    self.cache = EvaluationCache(model, cache_size) if cache_size else None
+    # with the symmetries of the game, symmetric positions share their cache entry
+    self.symmetries = symmetries
 
   def value_fn(self, game):
+    if self.cache is not None:
+      return self.evaluate(game)[1]
     observation = torch.tensor(game.to_observation(), device=self.model.device, requires_grad=False)
     value = self.model.value_forward(observation)
     return value.item()
 
   def policy_fn(self, game):
+    if self.cache is not None:
+      return self.evaluate(game)[0]
     observation = torch.tensor(game.to_observation(), device=self.model.device, requires_grad=False)
     policy = self.model.policy_forward(observation)
     return policy.cpu().numpy()
 
+  def evaluate(self, game):
+    # a single forward pass for both the policy and the value
+    observation = game.to_observation()
+    if self.cache is not None:
+      self.cache.check_weights()
+      key, observation, permutation = self._canonicalize(observation)
+      if (entry := self.cache.get(key)) is not None:
+        return self._uncanonicalize(entry, permutation)
+    policy, value = self.model.predict(torch.tensor(observation, device=self.model.device, requires_grad=False))
+    policy, value = policy.cpu().numpy(), value.item()
+    if self.cache is not None:
+      self.cache.put(key, policy, value)
+      return self._uncanonicalize((policy, value), permutation)
+    return policy, value
+
+  def evaluate_observations(self, observations):
+    if self.cache is None:
+      return self._predict_observations(observations)
+    # only the observations that aren't cached are evaluated
+    self.cache.check_weights()
+    keys, observations, permutations = zip(*(self._canonicalize(observation) for observation in observations))
+    entries = [self.cache.get(key) for key in keys]
+    misses = [i for i, entry in enumerate(entries) if entry is None]
+    if misses:
+      policies, values = self._predict_observations(np.stack([observations[i] for i in misses]))
+      for i, policy, value in zip(misses, policies, values):
+        entries[i] = (policy, value)
+        self.cache.put(keys[i], policy, value)
+    policies, values = zip(
+      *(self._uncanonicalize(entry, permutation) for entry, permutation in zip(entries, permutations))
+    )
+    return np.stack(policies), np.array(values, dtype=np.float32)
+
+  def _canonicalize(self, observation):
+    # the symmetric observation with the smallest bytes stands for all of them. Returns its cache key, the
+    # observation itself and the permutation of the actions that leads to it (None without symmetries)
+    if self.symmetries is None:
+      return observation.tobytes(), observation, None
+    observation_permutations, action_permutations = self.symmetries
+    candidates = observation.reshape(-1)[observation_permutations]
+    keys = [candidate.tobytes() for candidate in candidates]
+    i = min(range(len(keys)), key=keys.__getitem__)
+    return keys[i], candidates[i].reshape(observation.shape), action_permutations[i]
+
+  @staticmethod
+  def _uncanonicalize(entry, permutation):
+    # maps the policy of the canonical observation back to the actions of the original one
+    if permutation is None:
+      return entry
+    policy, value = entry
+    original_policy = np.empty_like(policy)
+    original_policy[permutation] = policy
+    return original_policy, value
+
+  def _predict_observations(self, observations):
+    observations = torch.tensor(observations, device=self.model.device, requires_grad=False)
+    policies, values = self.model.predict(observations)
+    return policies.cpu().numpy(), values.view(-1).cpu().numpy()
+
+
+class ThroughputMeter:
+  def __init__(self):
+    self.count = 0
+    self.started = time.perf_counter()
+
+  def add(self, count):
+    self.count += count
+
+  @property
+  def rate(self):
+    return self.count / max(time.perf_counter() - self.started, 1e-9)
+
+
+class BatchPrefetcher:
+  # samples the training batches from a replay buffer in a background thread, up to depth batches ahead of the
+  # training step. They're written through NumPy views into reused tensors, pinned when training on a GPU, so
+  # handing them over copies nothing. The replay buffer must not change while batches() runs
+  def __init__(self, replay_buffer, batch_size, depth=2, pin_memory=False):
+    self.replay_buffer = replay_buffer
+    self.batch_size = batch_size
+    # one more set of tensors than the batches ahead, for the batch being trained on
+    self.slots = [
+      tuple(torch.empty(shape, pin_memory=pin_memory) for shape in replay_buffer.batch_shapes(batch_size))
+      for _ in range(depth + 1)
+    ]
+
+  def batches(self, num_batches):
+    # yields num_batches batches like ReplayBuffer.sample_for_training. A batch is overwritten once the next one
+    # is requested
+    ready, free = queue.Queue(), queue.Queue()
+    for slot in self.slots:
+      free.put(slot)
+
+    def prefetch():
+      try:
+        for _ in range(num_batches):
+          slot = free.get()
+          batch = self.replay_buffer.sample_for_training(self.batch_size, tuple(tensor.numpy() for tensor in slot))
+          ready.put((*slot, *batch[3:]))
+      except Exception as exception:
+        ready.put(exception)
+
+    threading.Thread(target=prefetch, daemon=True).start()
+    for _ in range(num_batches):
+      batch = ready.get()
+      if isinstance(batch, Exception):
+        raise batch
+      yield batch
+      free.put(batch[:3])
+
 
 class AlphaZeroAgentTrainer(AlphaZeroAgent):
-  def __init__(self, model, optimizer, replay_buffer_max_size):
-    super().__init__(model)
+  def __init__(
+    self,
+    model,
+    optimizer,
+    replay_buffer_max_size,
+    cache_size=0,
+    replay_buffer_path=None,
+    symmetries=None,
+    compact_replay_buffer=False,
+    prioritized_replay=False,
+    deduplicate_replay=False,
+    prefetch_batches=0,
+  ):
+    super().__init__(model, cache_size, symmetries)
     self.optimizer = optimizer
-    self.replay_buffer = ReplayBuffer(max_size=replay_buffer_max_size)
+    # with prefetch_batches > 0, a background thread samples up to that many batches ahead of the training step
+    self.prefetch_batches = prefetch_batches
+    self.prefetcher = None
+    # a replay buffer with a path is kept on disk, and resumed from there. With symmetries, it trains on a random
+    # symmetric version of every sample, a prioritized one draws the samples with a high loss more often and a
+    # deduplicating one merges the repeated positions
+    replay_buffer_kwargs = {
+      "symmetries": symmetries,
+      "compact": compact_replay_buffer,
+      "prioritized": prioritized_replay,
+      "deduplicate": deduplicate_replay,
+    }
+    if replay_buffer_path is None:
+      self.replay_buffer = ReplayBuffer(replay_buffer_max_size, **replay_buffer_kwargs)
+    else:
+      self.replay_buffer = PersistentReplayBuffer(replay_buffer_max_size, replay_buffer_path, **replay_buffer_kwargs)
 
-  def _selfplay(self, game, search_iterations, c_puct=1.0, dirichlet_alpha=None):
+  def _selfplay(
+    self,
+    game,
+    search_iterations,
+    c_puct=1.0,
+    dirichlet_alpha=None,
+    backend="nodes",
+    search_batch_size=1,
+    reuse_tree=False,
+    gumbel=False,
+  ):
     buffer = []
+    tree = TREE_BACKENDS[backend]() if reuse_tree else None
     while (first_person_result := game.get_first_person_result()) is None:
-      root_node = search(
-        game, self.value_fn, self.policy_fn, search_iterations, c_puct=c_puct, dirichlet_alpha=dirichlet_alpha
-      )
-      visits_dist = root_node.children_visits / root_node.children_visits.sum()
-
-      action = root_node.children_actions[np.random.choice(len(root_node.children), p=visits_dist)]
+      if gumbel:
+        # the Gumbel noise already explores, and the completed-Q policy replaces the visits distribution
+        root_node = gumbel_search(
+          game,
+          self.value_fn,
+          self.policy_fn,
+          search_iterations,
+          c_puct=c_puct,
+          backend=backend,
+          tree=tree,
+          evaluate_fn=self.evaluate,
+        )
+        action, policy_target = root_node.selected_action, root_node.improved_policy
+      else:
+        root_node = search(
+          game,
+          self.value_fn,
+          self.policy_fn,
+          search_iterations,
+          c_puct=c_puct,
+          dirichlet_alpha=dirichlet_alpha,
+          backend=backend,
+          batch_size=search_batch_size,
+          batch_evaluate_fn=self.evaluate_observations,
+          evaluate_fn=self.evaluate,
+          tree=tree,
+        )
+        policy_target = root_node.children_visits / root_node.children_visits.sum()
+        action = root_node.children_actions[np.random.choice(len(root_node.children_actions), p=policy_target)]
 
       actions_dist = np.zeros(game.action_space, dtype=np.float32)
-      actions_dist[root_node.children_actions] = visits_dist
+      actions_dist[root_node.children_actions] = policy_target
       buffer.append((game.to_observation(), actions_dist))
 
       game.step(action)
+      if reuse_tree:
+        tree.advance(action)
 
     return first_person_result, buffer
 
-  def train_step(self, game, search_iterations, batch_size, epochs, c_puct=1.0, dirichlet_alpha=None):
-    first_person_result, game_buffer = self._selfplay(
-      game, search_iterations, c_puct=c_puct, dirichlet_alpha=dirichlet_alpha
-    )
+  def _selfplay_lockstep(self, games, num_games, search_iterations, c_puct=1.0, dirichlet_alpha=None, backend="nodes"):
+    # plays num_games games keeping len(games) of them in flight, and yields each one as soon as it ends.
+    # A finished game is reset to start the next one in its place
+    trees = [TREE_BACKENDS[backend]() for _ in games]
+    buffers = [[] for _ in games]
+    active = list(range(min(len(games), num_games)))
+    started = len(active)
+    while active:
+      search_lockstep(
+        [games[i] for i in active],
+        [trees[i] for i in active],
+        self.evaluate_observations,
+        search_iterations,
+        c_puct=c_puct,
+        dirichlet_alpha=dirichlet_alpha,
+      )
+      for i in list(active):
+        game, tree = games[i], trees[i]
+        visits_dist = tree.children_visits / tree.children_visits.sum()
+        action = tree.children_actions[np.random.choice(len(tree.children_actions), p=visits_dist)]
+
+        actions_dist = np.zeros(game.action_space, dtype=np.float32)
+        actions_dist[tree.children_actions] = visits_dist
+        buffers[i].append((game.to_observation(), actions_dist))
 
+        game.step(action)
+        tree.advance(action)
+        if (first_person_result := game.get_first_person_result()) is not None:
+          yield game, first_person_result, buffers[i]
+          buffers[i] = []
+          tree.reset()
+          if started < num_games:
+            game.reset()
+            started += 1
+          else:
+            active.remove(i)
+
+  def _store_game(self, game, first_person_result, game_buffer):
+    # the results are seen by the player to move in each position, going back from the end of the game
+    results = np.empty(len(game_buffer), dtype=np.float32)
     result = game.swap_result(first_person_result)
-    while len(game_buffer) > 0:
-      observation, action_dist = game_buffer.pop()
-      self.replay_buffer.add_sample(observation, action_dist, result)
+    for i in range(len(game_buffer) - 1, -1, -1):
+      results[i] = result
       result = game.swap_result(result)
+    observations, actions_dist = zip(*game_buffer)
+    self.replay_buffer.add_samples(np.stack(observations), np.stack(actions_dist), results)
+
+  def _train_batch(self, batch):
+    observations, actions_dist, results, indices, weights = batch
+    # the sampled arrays, or the prefetched tensors, are only copied to move them to the GPU
+    observations, actions_dist, results = (
+      torch.as_tensor(array).to(self.model.device, non_blocking=True) for array in (observations, actions_dist, results)
+    )
+
+    self.optimizer.zero_grad()
+    values, log_policies = self.model(observations)
+
+    # squared error
+    values_losses = F.mse_loss(values.squeeze(1), results, reduction="none")
+    # Kullback–Leibler divergence
+    policies_losses = F.kl_div(log_policies, actions_dist, reduction="none").sum(1)
+    if self.replay_buffer.prioritized:
+      # the samples with the highest loss are drawn the most, and weighted the least to keep the gradient unbiased
+      self.replay_buffer.update_priorities(indices, (values_losses + policies_losses).detach().cpu().numpy())
+      weights = torch.from_numpy(weights).to(self.model.device)
+      values_loss, policies_loss = (values_losses * weights).mean(), (policies_losses * weights).mean()
+    else:
+      values_loss, policies_loss = values_losses.mean(), policies_losses.mean()
 
+    (values_loss + policies_loss).backward()
+    self.optimizer.step()
+
+    return values_loss.item(), policies_loss.item()
+
+  def _train(self, batch_size, epochs):
     values_losses, policies_losses = [], []
     if len(self.replay_buffer) >= batch_size:
-      for _ in range(epochs):
-        observations, actions_dist, results = self.replay_buffer.sample(batch_size)
-        observations = torch.tensor(observations, device=self.model.device)
-        actions_dist = torch.tensor(actions_dist, device=self.model.device)
-        results = torch.tensor(results, device=self.model.device)
+      if self.prefetch_batches:
+        if self.prefetcher is None or self.prefetcher.batch_size != batch_size:
+          self.prefetcher = BatchPrefetcher(
+            self.replay_buffer, batch_size, self.prefetch_batches, pin_memory=self.model.device.type == "cuda"
+          )
+        batches = self.prefetcher.batches(epochs)
+      else:
+        batches = (self.replay_buffer.sample_for_training(batch_size) for _ in range(epochs))
+      for batch in batches:
+        values_loss, policies_loss = self._train_batch(batch)
+        values_losses.append(values_loss)
+        policies_losses.append(policies_loss)
 
-        self.optimizer.zero_grad()
-        values, log_policies = self.model(observations)
+    return values_losses, policies_losses
 
-        # mean squared error
-        values_loss = F.mse_loss(values.squeeze(1), results)
-        # Kullback–Leibler divergence
-        policies_loss = F.kl_div(log_policies, actions_dist, reduction="batchmean")
+  def train_step(
+    self,
+    game,
+    search_iterations,
+    batch_size,
+    epochs,
+    c_puct=1.0,
+    dirichlet_alpha=None,
+    backend="nodes",
+    search_batch_size=1,
+    reuse_tree=False,
+    gumbel=False,
+  ):
+    first_person_result, game_buffer = self._selfplay(
+      game,
+      search_iterations,
+      c_puct=c_puct,
+      dirichlet_alpha=dirichlet_alpha,
+      backend=backend,
+      search_batch_size=search_batch_size,
+      reuse_tree=reuse_tree,
+      gumbel=gumbel,
+    )
+    self._store_game(game, first_person_result, game_buffer)
+    return self._train(batch_size, epochs)
 
-        (values_loss + policies_loss).backward()
-        self.optimizer.step()
+  def train_step_lockstep(
+    self,
+    games,
+    num_games,
+    search_iterations,
+    batch_size,
+    epochs,
+    c_puct=1.0,
+    dirichlet_alpha=None,
+    backend="nodes",
+  ):
+    # like num_games calls to train_step, but the self-play games are played len(games) at a time, evaluating
+    # the leaves of all of their trees with a single forward pass
+    values_losses, policies_losses = [], []
+    for game, first_person_result, game_buffer in self._selfplay_lockstep(
+      games, num_games, search_iterations, c_puct=c_puct, dirichlet_alpha=dirichlet_alpha, backend=backend
+    ):
+      self._store_game(game, first_person_result, game_buffer)
+      game_values_losses, game_policies_losses = self._train(batch_size, epochs)
+      values_losses += game_values_losses
+      policies_losses += game_policies_losses
+    return values_losses, policies_losses
 
-        values_losses.append(values_loss.item())
-        policies_losses.append(policies_loss.item())
+  def train_async(self, game, selfplay_games, search_iterations, batch_size, sample_reuse=4.0, **selfplay_kwargs):
+    # self-play runs in this thread while a training thread keeps the ratio between the samples it trained on and
+    # the samples self-play generated close to sample_reuse. Self-play uses its own copy of the model, synced after
+    # every game, so that the two threads never share a forward pass. Yields the losses of the training steps run
+    # during each game, and meters both sides in selfplay_meter and training_meter (samples/sec)
+    selfplay_agent = AlphaZeroAgentTrainer(copy.deepcopy(self.model), None, 0)
+    self.selfplay_meter, self.training_meter = ThroughputMeter(), ThroughputMeter()
+    condition = threading.Condition()
+    # the training steps run outside of the condition, so that storing a game never waits for one. Self-play
+    # copies the weights from a snapshot taken after the last step instead, never seeing a step half applied
+    latest_weights = [None]
+    stop = threading.Event()
+    values_losses, policies_losses = [], []
+    # an exception raised by the training thread, re-raised by this one
+    errors = []
 
-    return values_losses, policies_losses
+    def can_train():
+      return (
+        len(self.replay_buffer) >= batch_size and self.training_meter.count < sample_reuse * self.selfplay_meter.count
+      )
+
+    def train_step():
+      # returns False once stopped
+      with condition:
+        condition.wait_for(lambda: stop.is_set() or can_train())
+        if stop.is_set():
+          return False
+        # the sampled arrays are only overwritten by the next sample, which this thread takes too
+        batch = self.replay_buffer.sample_for_training(batch_size)
+      values_loss, policies_loss = self._train_batch(batch)
+      weights = {name: tensor.detach().clone() for name, tensor in self.model.state_dict().items()}
+      with condition:
+        latest_weights[0] = weights
+        values_losses.append(values_loss)
+        policies_losses.append(policies_loss)
+        self.training_meter.add(batch_size)
+      return True
+
+    def train():
+      try:
+        while train_step():
+          pass
+      except Exception as exception:
+        errors.append(exception)
+
+    trainer = threading.Thread(target=train, daemon=True)
+    trainer.start()
+    try:
+      for _ in range(selfplay_games):
+        game.reset()
+        first_person_result, game_buffer = selfplay_agent._selfplay(game, search_iterations, **selfplay_kwargs)
+        with condition:
+          if errors:
+            raise errors[0]
+          self.selfplay_meter.add(len(game_buffer))
+          self._store_game(game, first_person_result, game_buffer)
+          weights = latest_weights[0]
+          game_losses = values_losses[:], policies_losses[:]
+          values_losses.clear()
+          policies_losses.clear()
+          condition.notify()
+        if weights is not None:
+          selfplay_agent.model.load_state_dict(weights)
+        yield game_losses
+    finally:
+      with condition:
+        stop.set()
+        condition.notify()
+      trainer.join()
+    # the training thread can also fail during the last game
+    if errors:
+      raise errors[0]
 
   def save_training_state(self, model_out_path, optimizer_out_path):
     torch.save(self.model.state_dict(), model_out_path)
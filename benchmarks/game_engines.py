@@ -0,0 +1,41 @@
+import random
+import time
+import os
+import sys
+
+sys.path.append(os.getcwd())
+from connect2.game import BitboardConnect2, Connect2  # noqa: E402
+from pylos.game import PylosGame  # noqa: E402
+from tictactoe.one_dim.game import BitboardTicTacToe, TicTacToe  # noqa: E402
+
+GAMES = 2000
+REPEATS = 3
+
+
+def play_games(game, num_games):
+  # random games where every legal action is tried with a step, a result check, an observation and an undo before
+  # one of them is played, like a search expanding every node it visits. Returns how many of those cycles were run
+  cycles = 0
+  for _ in range(num_games):
+    game.reset()
+    while game.get_result() is None:
+      actions = game.get_legal_actions()
+      for action in actions:
+        game.step(action)
+        game.get_first_person_result()
+        game.to_observation()
+        game.undo_last_action()
+      cycles += len(actions)
+      game.step(random.choice(actions))
+  return cycles
+
+
+if __name__ == "__main__":
+  random.seed(0)
+  for game in (TicTacToe(), BitboardTicTacToe(), Connect2(), BitboardConnect2(), PylosGame()):
+    speeds = []
+    for _ in range(REPEATS):
+      start = time.perf_counter()
+      cycles = play_games(game, GAMES)
+      speeds.append(cycles / (time.perf_counter() - start))
+    print(f"{type(game).__name__:<18} {max(speeds):10.0f} step+result+observation+undo cycles/sec")
@@ -0,0 +1,59 @@
+import time
+import torch
+import numpy as np
+import os
+import sys
+import warnings
+
+sys.path.append(os.getcwd())
+from models import InferenceModel, LinearNetwork, TicTacToe2DNetwork  # noqa: E402
+from pylos.game import PylosGame  # noqa: E402
+from tictactoe.two_dim.game import TicTacToe  # noqa: E402
+
+BATCH_SIZES = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+CALLS = 200
+ACCURACY_POSITIONS = 1024
+
+
+def random_observations(game, count):
+  # observations of the positions met while playing random games
+  observations = []
+  while len(observations) < count:
+    game.reset()
+    while game.get_first_person_result() is None and len(observations) < count:
+      observations.append(game.to_observation())
+      legal_actions = game.get_legal_actions()
+      game.step(legal_actions[np.random.randint(len(legal_actions))])
+  return torch.tensor(np.stack(observations))
+
+
+def latency_us(predict, observations):
+  predict(observations)
+  start = time.perf_counter()
+  for _ in range(CALLS):
+    predict(observations)
+  return (time.perf_counter() - start) / CALLS * 1e6
+
+
+if __name__ == "__main__":
+  # TorchScript is deprecated in recent versions of torch, but it's still the way to save a frozen model
+  warnings.filterwarnings("ignore", category=FutureWarning)
+  torch.set_num_threads(1)
+  for game, model_class in ((PylosGame(), LinearNetwork), (TicTacToe(), TicTacToe2DNetwork)):
+    model = model_class(game.observation_shape, game.action_space)
+    observations = random_observations(game, ACCURACY_POSITIONS)
+    variants = {
+      "fp32 eager": model,
+      "fp32 script": InferenceModel.export(model, observations),
+      "int8 script": InferenceModel.export(model, observations, quantize=True),
+    }
+
+    print(f"{model_class.__name__} on {type(game).__name__}")
+    for name, variant in variants.items():
+      if isinstance(variant, InferenceModel):
+        policy_error, value_error = variant.check_accuracy(model, observations)
+        print(f"  {name}: max policy error {policy_error:.2e}, max value error {value_error:.2e}")
+    print("  batch size " + "".join(f"{name:>14}" for name in variants) + "  (us per call)")
+    for batch_size in BATCH_SIZES:
+      latencies = [latency_us(variant.predict, observations[:batch_size]) for variant in variants.values()]
+      print(f"  {batch_size:>10} " + "".join(f"{latency:14.1f}" for latency in latencies))
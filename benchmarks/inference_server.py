@@ -0,0 +1,48 @@
+import time
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.getcwd())
+from agents import AlphaZeroAgent  # noqa: E402
+from inference import InferenceServer  # noqa: E402
+from mcts import search  # noqa: E402
+from models import LinearNetwork  # noqa: E402
+from pylos.game import PylosGame  # noqa: E402
+
+NUM_WORKERS = (1, 4, 16, 64)
+SEARCHES_PER_WORKER = 4
+SEARCH_ITERATIONS = 200
+MAX_BATCH_SIZE = 64
+MAX_WAIT_MS = 1.0
+
+
+def run_searches(agent):
+  game = PylosGame()
+  for _ in range(SEARCHES_PER_WORKER):
+    search(game, agent.value_fn, agent.policy_fn, SEARCH_ITERATIONS, evaluate_fn=agent.evaluate)
+
+
+def simulations_per_second(agents):
+  start = time.perf_counter()
+  with ThreadPoolExecutor(len(agents)) as executor:
+    for future in [executor.submit(run_searches, agent) for agent in agents]:
+      future.result()
+  return len(agents) * SEARCHES_PER_WORKER * SEARCH_ITERATIONS / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+  game = PylosGame()
+  model = LinearNetwork(game.observation_shape, game.action_space)
+
+  print(f"{SEARCHES_PER_WORKER} searches of {SEARCH_ITERATIONS} simulations per worker thread")
+  for num_workers in NUM_WORKERS:
+    speed = simulations_per_second([AlphaZeroAgent(model) for _ in range(num_workers)])
+    print(f"  {num_workers:>2} workers, one forward per evaluation: {speed:10.0f} simulations/sec")
+
+    with InferenceServer(model, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS) as server:
+      speed = simulations_per_second([server.client() for _ in range(num_workers)])
+      print(
+        f"  {num_workers:>2} workers, inference server: {speed:10.0f} simulations/sec, "
+        f"{server.fill_rate:.0%} batch fill rate, {server.mean_queue_latency_ms:.2f} ms queue latency"
+      )
@@ -0,0 +1,30 @@
+import time
+import torch
+import os
+import sys
+
+sys.path.append(os.getcwd())
+from agents import AlphaZeroAgentTrainer  # noqa: E402
+from models import LinearNetwork  # noqa: E402
+from tictactoe.one_dim.game import TicTacToe  # noqa: E402
+
+LOCKSTEP_GAMES = (1, 16, 64, 256)
+SELFPLAY_GAMES = 512
+SEARCH_ITERATIONS = 32
+BACKEND = "array"
+
+
+if __name__ == "__main__":
+  game = TicTacToe()
+  model = LinearNetwork(game.observation_shape, game.action_space)
+  optimizer = torch.optim.AdamW(model.parameters())
+  # no training, so that only self-play is measured
+  agent = AlphaZeroAgentTrainer(model, optimizer, SELFPLAY_GAMES * game.action_space)
+
+  print(f"Lockstep self-play, {SELFPLAY_GAMES} games, {SEARCH_ITERATIONS} simulations per move, {BACKEND} backend")
+  for num_games in LOCKSTEP_GAMES:
+    games = [TicTacToe() for _ in range(num_games)]
+    start = time.perf_counter()
+    agent.train_step_lockstep(games, SELFPLAY_GAMES, SEARCH_ITERATIONS, 1, 0, backend=BACKEND)
+    speed = SELFPLAY_GAMES / (time.perf_counter() - start)
+    print(f"  {num_games:>3} games in flight: {speed * 3600:10.0f} games/hour")
@@ -0,0 +1,60 @@
+import time
+import torch
+import os
+import sys
+
+sys.path.append(os.getcwd())
+from agents import AlphaZeroAgent, AlphaZeroAgentTrainer, ClassicMCTSAgent  # noqa: E402
+from distributed import train_distributed  # noqa: E402
+from mcts import search  # noqa: E402
+from models import LinearNetwork  # noqa: E402
+from pylos.game import PylosGame  # noqa: E402
+
+THREAD_COUNTS = (1, 2, 4, 8, 16, 32)
+ROOT_PARALLEL_ITERATIONS = 20000
+TREE_PARALLEL_ITERATIONS = 2000
+ACTORS_SELFPLAY_GAMES = 64
+ACTORS_SEARCH_ITERATIONS = 16
+
+
+def simulations_per_second(game, agent, iterations, **search_kwargs):
+  start = time.perf_counter()
+  search(game, agent.value_fn, agent.policy_fn, iterations, **search_kwargs)
+  return iterations / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+  # every thread runs its own forward passes, so they shouldn't compete for torch's intra-op threads
+  torch.set_num_threads(1)
+  game = PylosGame()
+  agent = AlphaZeroAgent(LinearNetwork(game.observation_shape, game.action_space))
+  max_threads = os.cpu_count()
+
+  print(f"Root parallel, classic MCTS agent with compiled rollouts, {ROOT_PARALLEL_ITERATIONS} simulations")
+  simulations_per_second(game, ClassicMCTSAgent(), 100, backend="compiled")
+  for num_threads in (n for n in THREAD_COUNTS if n <= max_threads):
+    speed = simulations_per_second(
+      game, ClassicMCTSAgent(), ROOT_PARALLEL_ITERATIONS, backend="compiled", parallel="root", num_threads=num_threads
+    )
+    print(f"  {num_threads:>2} threads: {speed:10.0f} simulations/sec")
+
+  print(f"Tree parallel, AlphaZero agent, {TREE_PARALLEL_ITERATIONS} simulations")
+  simulations_per_second(game, agent, 100, backend="array")
+  for num_threads in (n for n in THREAD_COUNTS if n <= max_threads):
+    speed = simulations_per_second(
+      game, agent, TREE_PARALLEL_ITERATIONS, backend="array", parallel="tree", num_threads=num_threads
+    )
+    print(f"  {num_threads:>2} threads: {speed:10.0f} simulations/sec")
+
+  print(
+    f"Self-play actors, AlphaZero agent, {ACTORS_SELFPLAY_GAMES} games, {ACTORS_SEARCH_ITERATIONS} simulations per move"
+  )
+  optimizer = torch.optim.AdamW(agent.model.parameters())
+  for num_actors in (n for n in THREAD_COUNTS if n <= max_threads):
+    # no training, so that only self-play is measured
+    trainer = AlphaZeroAgentTrainer(agent.model, optimizer, ACTORS_SELFPLAY_GAMES * game.action_space)
+    start = time.perf_counter()
+    for _ in train_distributed(trainer, game, num_actors, ACTORS_SELFPLAY_GAMES, ACTORS_SEARCH_ITERATIONS, 1, 0):
+      pass
+    speed = ACTORS_SELFPLAY_GAMES / (time.perf_counter() - start)
+    print(f"  {num_actors:>2} actors: {speed:10.2f} games/sec")
@@ -0,0 +1,51 @@
+import time
+import numpy as np
+import os
+import sys
+
+sys.path.append(os.getcwd())
+from mcts import search, TREE_BACKENDS  # noqa: E402
+from pylos.game import PylosGame  # noqa: E402
+from tictactoe.one_dim.game import TicTacToe  # noqa: E402
+
+SEARCH_ITERATIONS = 5000
+SEARCH_BATCH_SIZES = (1, 16)
+REPEATS = 3
+
+
+# constant-time value and policy functions, so that only the tree itself is measured
+def make_agent_fns(action_space):
+  policy = np.ones(action_space, dtype=np.float32) / action_space
+
+  def value_fn(game):
+    return 0.0
+
+  def policy_fn(game):
+    return policy
+
+  def batch_evaluate_fn(observations):
+    return np.tile(policy, (len(observations), 1)), np.zeros(len(observations), dtype=np.float32)
+
+  return value_fn, policy_fn, batch_evaluate_fn
+
+
+if __name__ == "__main__":
+  for game in (TicTacToe(), PylosGame()):
+    value_fn, policy_fn, batch_evaluate_fn = make_agent_fns(game.action_space)
+    for batch_size in SEARCH_BATCH_SIZES:
+      search_kwargs = {"batch_size": batch_size, "batch_evaluate_fn": batch_evaluate_fn}
+      # warm up the jitted functions
+      for backend in TREE_BACKENDS:
+        search(game, value_fn, policy_fn, 10, backend=backend, **search_kwargs)
+
+      print(f"{type(game).__name__}, {SEARCH_ITERATIONS} simulations, batch size {batch_size}")
+      for backend in TREE_BACKENDS:
+        elapsed = []
+        for _ in range(REPEATS):
+          start = time.perf_counter()
+          tree = search(game, value_fn, policy_fn, SEARCH_ITERATIONS, backend=backend, **search_kwargs)
+          elapsed.append(time.perf_counter() - start)
+        line = f"  {backend:>8}: {SEARCH_ITERATIONS / min(elapsed):10.0f} nodes/sec"
+        if hasattr(tree, "nbytes"):
+          line += f", {tree.nbytes / tree.capacity:.0f} bytes/node"
+        print(line)
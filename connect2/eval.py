@@ -12,6 +12,7 @@ from agents import AlphaZeroAgent  # noqa: E402
 from mcts import pit # noqa: E402
 
 EVAL_GAMES = 100
+CACHE_SIZE = 10_000  # evaluations cached by the agent, enough for every reachable position
 
 if __name__ == "__main__":
   game = Connect2()
@@ -19,7 +20,7 @@ if __name__ == "__main__":
   model = LinearNetwork(game.observation_shape, game.action_space)
   model.load_state_dict(torch.load(f"{OUT_DIR}/model.pth"))
 
-  agent = AlphaZeroAgent(model)
+  agent = AlphaZeroAgent(model, cache_size=CACHE_SIZE)
   agent_play_kwargs = {"search_iterations": SEARCH_ITERATIONS, "c_puct": 1.5, "dirichlet_alpha": 0.3}
 
   print(f"Playing {EVAL_GAMES} games against itself")
@@ -1,8 +1,63 @@
 import numpy as np
+from numba import njit
+
+STATE_LEN = 4
+# the board and its mirror image, as index permutations: the symmetric cells are cells[permutation]
+BOARD_SYMMETRIES = np.array([np.arange(STATE_LEN), np.arange(STATE_LEN)[::-1]])
+
+# the two cells of every winning pair as a bitmask, and for every cell the masks of the pairs it's part of
+WIN_MASKS = [0b11 << cell for cell in range(STATE_LEN - 1)]
+CELL_WIN_MASKS = [[mask for mask in WIN_MASKS if mask >> cell & 1] for cell in range(STATE_LEN)]
+FULL_BOARD = (1 << STATE_LEN) - 1
+
+
+# array state: the cells followed by the player to move
+@njit(cache=True)
+def array_legal_actions(state, out):
+  n = 0
+  for i in range(STATE_LEN):
+    if state[i] == 0:
+      out[n] = i
+      n += 1
+  return n
+
+
+@njit(cache=True)
+def array_step(state, action):
+  state[action] = state[STATE_LEN]
+  state[STATE_LEN] = -state[STATE_LEN]
+
+
+@njit(cache=True)
+def array_undo(state, action):
+  state[action] = 0
+  state[STATE_LEN] = -state[STATE_LEN]
+
+
+@njit(cache=True)
+def array_first_person_result(state):
+  for i in range(STATE_LEN - 1):
+    if state[i] != 0 and state[i] == state[i + 1]:
+      return float(state[i] * state[STATE_LEN])
+  for i in range(STATE_LEN):
+    if state[i] == 0:
+      return np.nan
+  return 0.0
+
+
+@njit(cache=True)
+def array_observation(state, out):
+  for i in range(STATE_LEN):
+    out[i] = state[i] * state[STATE_LEN]
 
 
 class Connect2:
-  STATE_LEN = 4
+  STATE_LEN = STATE_LEN
+  # one random key for every (cell, player) pair, xored in and out of the position hash as stones come and go
+  ZOBRIST_KEYS = np.random.default_rng(0).integers(1, 2**63, size=(STATE_LEN, 2)).tolist()
+  ARRAY_FUNCTIONS = (array_legal_actions, array_step, array_undo, array_first_person_result, array_observation)
+  # the permutations of the observation and of the actions under every symmetry of the board
+  SYMMETRIES = (BOARD_SYMMETRIES, BOARD_SYMMETRIES)
 
   def __init__(self):
     self.reset()
@@ -14,6 +69,7 @@ class Connect2:
     self.state = [0] * self.STATE_LEN
     self.actions_stack = []
     self.turn = 1
+    self.position_hash = 0
 
   def __str__(self):
     return str(self.state)
@@ -27,6 +83,9 @@ class Connect2:
         obs[i] = -1
     return obs
 
+  def to_array_state(self):
+    return np.array(self.state + [self.turn], dtype=np.int64)
+
   def get_legal_actions(self):
     return [i for i, x in enumerate(self.state) if x == 0]
 
@@ -35,11 +94,14 @@ class Connect2:
       raise ValueError(f"Action {action} is illegal")
     self.state[action] = self.turn
     self.actions_stack.append(action)
+    self.position_hash ^= self.ZOBRIST_KEYS[action][(1 - self.turn) // 2]
     self.turn *= -1
 
   def undo_last_action(self):
-    self.state[self.actions_stack.pop()] = 0
+    action = self.actions_stack.pop()
+    self.state[action] = 0
     self.turn *= -1
+    self.position_hash ^= self.ZOBRIST_KEYS[action][(1 - self.turn) // 2]
 
   def get_result(self):
     for x, y in zip(self.state[:-1], self.state[1:]):
@@ -57,3 +119,65 @@ class Connect2:
   @staticmethod
   def swap_result(result):
     return -result
+
+
+class BitboardConnect2(Connect2):
+  # the same game, with the stones of each player kept as the bits of an integer. Only the pairs through the last
+  # stone are checked for a win, a draw is a full board, and the observations of both players are updated in place
+  # by step and undo_last_action instead of being rebuilt
+  def reset(self):
+    # the stones of the first and of the second player, and the observation each of them sees
+    self.boards = [0, 0]
+    self.observations = [np.zeros(self.STATE_LEN, dtype=np.float32), np.zeros(self.STATE_LEN, dtype=np.float32)]
+    self.actions_stack = []
+    self.turn = 1
+    self.position_hash = 0
+
+  @property
+  def state(self):
+    return [(self.boards[0] >> i & 1) - (self.boards[1] >> i & 1) for i in range(self.STATE_LEN)]
+
+  def to_observation(self):
+    return self.observations[(1 - self.turn) // 2].copy()
+
+  def get_legal_actions(self):
+    empty = ~(self.boards[0] | self.boards[1]) & FULL_BOARD
+    actions = []
+    while empty:
+      action = (empty & -empty).bit_length() - 1
+      actions.append(action)
+      empty ^= 1 << action
+    return actions
+
+  def step(self, action):
+    # the array backends play NumPy integers, which would turn the boards into fixed-size integers
+    bit = 1 << int(action)
+    if (self.boards[0] | self.boards[1]) & bit:
+      raise ValueError(f"Action {action} is illegal")
+    player = (1 - self.turn) // 2
+    self.boards[player] |= bit
+    self.observations[player][action] = 1
+    self.observations[1 - player][action] = -1
+    self.actions_stack.append(action)
+    self.position_hash ^= self.ZOBRIST_KEYS[action][player]
+    self.turn = -self.turn
+
+  def undo_last_action(self):
+    action = self.actions_stack.pop()
+    self.turn = -self.turn
+    player = (1 - self.turn) // 2
+    self.boards[player] ^= 1 << int(action)
+    self.observations[0][action] = 0
+    self.observations[1][action] = 0
+    self.position_hash ^= self.ZOBRIST_KEYS[action][player]
+
+  def get_result(self):
+    if not self.actions_stack:
+      return
+    # only the player who moved last can have just completed a pair
+    board = self.boards[(1 + self.turn) // 2]
+    for mask in CELL_WIN_MASKS[self.actions_stack[-1]]:
+      if (board & mask) == mask:
+        return -self.turn
+    if (self.boards[0] | self.boards[1]) == FULL_BOARD:
+      return 0
@@ -0,0 +1,113 @@
+import copy
+import queue
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from agents import AlphaZeroAgentTrainer
+
+
+class SharedWeights:
+  # the learner publishes its weights into shared memory tensors and bumps the version, the actors copy them
+  # into their own model whenever the version they hold is older
+  def __init__(self, model, ctx):
+    self.state_dict = {
+      name: tensor.detach().cpu().clone().share_memory_() for name, tensor in model.state_dict().items()
+    }
+    self.version = ctx.Value("i", 0)
+
+  def publish(self, model):
+    with self.version.get_lock():
+      for name, tensor in model.state_dict().items():
+        self.state_dict[name].copy_(tensor)
+      self.version.value += 1
+
+  def pull(self, model, version):
+    with self.version.get_lock():
+      if self.version.value != version:
+        model.load_state_dict(self.state_dict)
+      return self.version.value
+
+
+def actor_loop(game, model, shared_weights, trajectories, stop, search_iterations, selfplay_kwargs):
+  # every process runs its own forward passes, so they shouldn't compete for torch's intra-op threads
+  torch.set_num_threads(1)
+  # the received model's parameters are in shared memory, where the other actors load their weights too
+  model = copy.deepcopy(model)
+  # actors only play, so they have neither an optimizer nor a replay buffer to fill
+  agent = AlphaZeroAgentTrainer(model, None, 0)
+  version = -1
+  while not stop.is_set():
+    version = shared_weights.pull(model, version)
+    game.reset()
+    first_person_result, buffer = agent._selfplay(game, search_iterations, **selfplay_kwargs)
+    observations, actions_dist = zip(*buffer)
+    # tensors go through the queue in shared memory instead of being pickled
+    trajectories.put(
+      (torch.from_numpy(np.stack(observations)), torch.from_numpy(np.stack(actions_dist)), first_person_result, version)
+    )
+
+
+def receive_trajectory(trajectories, actors, timeout=1):
+  # actors only exit once they're stopped, so an exited one crashed and might have been the last one playing
+  while True:
+    try:
+      return trajectories.get(timeout=timeout)
+    except queue.Empty:
+      for actor in actors:
+        if actor.exitcode is not None:
+          raise RuntimeError(f"A self-play actor exited with code {actor.exitcode}")
+
+
+def train_distributed(
+  agent,
+  game,
+  num_actors,
+  selfplay_games,
+  search_iterations,
+  batch_size,
+  epochs,
+  publish_interval=1,
+  **selfplay_kwargs,
+):
+  # num_actors processes play self-play games with a CPU copy of the model, while this process is the learner: it
+  # owns the replay buffer and the optimizer, trains on each game it receives like train_step does and publishes
+  # its weights every publish_interval games. Yields the losses of each training step
+  ctx = mp.get_context("spawn")
+  shared_weights = SharedWeights(agent.model, ctx)
+  trajectories = ctx.Queue()
+  stop = ctx.Event()
+
+  actor_model = copy.deepcopy(agent.model).cpu()
+  actor_model.device = torch.device("cpu")
+  actors = [
+    ctx.Process(
+      target=actor_loop,
+      args=(copy.deepcopy(game), actor_model, shared_weights, trajectories, stop, search_iterations, selfplay_kwargs),
+      daemon=True,
+    )
+    for _ in range(num_actors)
+  ]
+  for actor in actors:
+    actor.start()
+
+  # how many versions behind the learner the weights that played the received games were
+  agent.weights_lags = []
+  try:
+    for i in range(selfplay_games):
+      observations, actions_dist, first_person_result, version = receive_trajectory(trajectories, actors)
+      agent.weights_lags.append(shared_weights.version.value - version)
+      agent._store_game(game, first_person_result, list(zip(observations.numpy(), actions_dist.numpy())))
+      yield agent._train(batch_size, epochs)
+      if (i + 1) % publish_interval == 0:
+        shared_weights.publish(agent.model)
+  finally:
+    stop.set()
+    # the actors might be blocked on a full queue until it's drained. The shared memory of the trajectories sent by
+    # the actors that already exited can't be attached anymore, but they're discarded anyway
+    while any(actor.is_alive() for actor in actors):
+      try:
+        trajectories.get(timeout=0.1)
+      except (queue.Empty, OSError):
+        pass
+    for actor in actors:
+      actor.join()
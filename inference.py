@@ -0,0 +1,137 @@
+import queue
+import threading
+import time
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+
+class InferenceClient:
+  # agent that sends its evaluations to an InferenceServer, so it can be searched and played with like any other
+  # agent. A client must only be used by one thread or process at a time
+  def __init__(self, requests, responses, client_id):
+    self.requests = requests
+    self.responses = responses
+    self.client_id = client_id
+
+  def evaluate_observations(self, observations):
+    # monotonic clocks are shared by all processes, so the server can measure how long the request waited
+    self.requests.put((self.client_id, np.asarray(observations), time.monotonic()))
+    response = self.responses.get()
+    if isinstance(response, Exception):
+      raise response
+    return response
+
+  def evaluate(self, game):
+    policies, values = self.evaluate_observations(game.to_observation()[None])
+    return policies[0], values[0].item()
+
+  def value_fn(self, game):
+    return self.evaluate(game)[1]
+
+  def policy_fn(self, game):
+    return self.evaluate(game)[0]
+
+
+class InferenceServer:
+  # owns the model and evaluates the requests of many clients together: a batch is run as soon as it holds
+  # max_batch_size observations, or max_wait_ms after its first request arrived
+  def __init__(self, model, max_batch_size=64, max_wait_ms=1.0, ctx=None):
+    self.model = model
+    self.max_batch_size = max_batch_size
+    self.max_wait = max_wait_ms / 1000
+    self.ctx = ctx or mp.get_context("spawn")
+    self.requests = self.ctx.Queue()
+    self.responses = []
+    self.thread = None
+    self.reset_stats()
+
+  def reset_stats(self):
+    self.batches = 0
+    self.requests_count = 0
+    self.observations_count = 0
+    self.queue_latency_sum = 0.0
+
+  @property
+  def fill_rate(self):
+    return self.observations_count / max(self.batches * self.max_batch_size, 1)
+
+  @property
+  def mean_batch_size(self):
+    return self.observations_count / max(self.batches, 1)
+
+  @property
+  def mean_queue_latency_ms(self):
+    return self.queue_latency_sum / max(self.requests_count, 1) * 1000
+
+  def client(self):
+    # the clients of other processes have to be created before starting them, and passed to them as arguments
+    responses = self.ctx.Queue()
+    self.responses.append(responses)
+    return InferenceClient(self.requests, responses, len(self.responses) - 1)
+
+  def start(self):
+    self.thread = threading.Thread(target=self._serve, daemon=True)
+    self.thread.start()
+    return self
+
+  def stop(self):
+    if self.thread is None:
+      return
+    self.requests.put(None)
+    self.thread.join()
+    self.thread = None
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, *args):
+    self.stop()
+
+  def _next_batch(self):
+    # blocks until the first request, then gathers more until the batch is full or the wait is over.
+    # Returns None once stopped
+    request = self.requests.get()
+    if request is None:
+      return None
+    batch, size = [request], len(request[1])
+    deadline = time.monotonic() + self.max_wait
+    while size < self.max_batch_size and (timeout := deadline - time.monotonic()) > 0:
+      try:
+        request = self.requests.get(timeout=timeout)
+      except queue.Empty:
+        break
+      if request is None:
+        # stop after this batch
+        self.requests.put(None)
+        break
+      batch.append(request)
+      size += len(request[1])
+    return batch
+
+  def _serve(self):
+    while (batch := self._next_batch()) is not None:
+      started = time.monotonic()
+      try:
+        observations = torch.tensor(
+          np.concatenate([observations for _, observations, _ in batch]), device=self.model.device
+        )
+        policies, values = self.model.predict(observations)
+        policies, values = policies.cpu().numpy(), values.view(-1).cpu().numpy()
+      except Exception as exception:
+        # the clients of the batch raise it instead of waiting forever, and the server keeps serving the others. It
+        # is sent as a RuntimeError since the original one might not be picklable by the queues of other processes
+        error = RuntimeError(f"The inference server failed to evaluate a batch: {exception!r}")
+        for client_id, _, _ in batch:
+          self.responses[client_id].put(error)
+        continue
+
+      start = 0
+      for client_id, client_observations, submitted in batch:
+        end = start + len(client_observations)
+        self.responses[client_id].put((policies[start:end], values[start:end]))
+        self.queue_latency_sum += started - submitted
+        start = end
+      self.batches += 1
+      self.requests_count += len(batch)
+      self.observations_count += len(observations)
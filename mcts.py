@@ -1,4 +1,9 @@
+import copy
 import math
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from numba import njit
 
@@ -37,7 +42,7 @@ class Node(RootNode):
     self.parent.children_values[self.idx] = x
 
 
-@njit(fastmath=True, parallel=True)
+@njit(fastmath=True)
 def get_ucb_scores_jitted(children_values, children_priors, visits, children_visits, c_puct):
   return children_values + c_puct * children_priors * math.sqrt(visits) / (children_visits + 1)
 
@@ -46,8 +51,12 @@ def get_ucb_scores(node, c_puct):
   return get_ucb_scores_jitted(node.children_values, node.children_priors, node.visits, node.children_visits, c_puct)
 
 
-def select(root, game, c_puct):
+def select(root, game, c_puct, root_child=None):
   current = root
+  # the first step can be forced, to only search below one of the root children
+  if root_child is not None:
+    current = root.children[root_child]
+    game.step(current.action)
   while current.children:
     ucb_scores = get_ucb_scores(current, c_puct)
     # every child needs at least 1 visit
@@ -78,43 +87,1113 @@ def backpropagate(leaf, game, result):
   current.visits += 1
 
 
-def search(game, value_fn, policy_fn, iterations, c_puct=1.0, dirichlet_alpha=None):
-  root = RootNode()
-  # expand the root so that there's no need to check if it's necessary to add dirichlet noise
-  # at every iteration of the search loop
-  children_actions = game.get_legal_actions()
-  children_priors = policy_fn(game)[children_actions]
-  if dirichlet_alpha:
-    children_priors = 0.75 * children_priors + 0.25 * np.random.default_rng().dirichlet(
-      dirichlet_alpha * np.ones_like(children_priors)
+def update(leaf, game, result):
+  current = leaf
+  while current.parent:
+    result = game.swap_result(result)
+    current.value = (current.value * current.visits + result) / (current.visits + 1)
+    current.visits += 1
+    current = current.parent
+  current.visits += 1
+
+
+def add_virtual_loss(leaf, virtual_loss):
+  current = leaf
+  while current.parent:
+    current.value = (current.value * current.visits - virtual_loss) / (current.visits + 1)
+    current.visits += 1
+    current = current.parent
+  current.visits += 1
+
+
+def revert_virtual_loss(leaf, virtual_loss):
+  current = leaf
+  while current.parent:
+    current.visits -= 1
+    current.value = (current.value * (current.visits + 1) + virtual_loss) / current.visits if current.visits else 0
+    current = current.parent
+  current.visits -= 1
+
+
+def get_depth(leaf):
+  depth = 0
+  while leaf.parent:
+    leaf = leaf.parent
+    depth += 1
+  return depth
+
+
+class NodeTree:
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    self.root = RootNode()
+    self.noisy_root = False
+
+  def advance(self, action):
+    # keep the statistics of the subtree below the played action and drop everything else
+    for child in self.root.children or []:
+      if child.action == action:
+        root = RootNode()
+        root.visits = child.visits
+        if child.children is not None:
+          root.children = child.children
+          root.children_actions = child.children_actions
+          root.children_priors = child.children_priors
+          root.children_values = child.children_values
+          root.children_visits = child.children_visits
+          for grandchild in root.children:
+            grandchild.parent = root
+        self.root = root
+        self.noisy_root = False
+        return
+    self.reset()
+
+  @property
+  def visits(self):
+    return self.root.visits
+
+  @property
+  def children(self):
+    return self.root.children
+
+  @property
+  def children_actions(self):
+    return self.root.children_actions
+
+  @property
+  def children_priors(self):
+    return self.root.children_priors
+
+  @children_priors.setter
+  def children_priors(self, x):
+    self.root.children_priors = x
+
+  @property
+  def children_values(self):
+    return self.root.children_values
+
+  @property
+  def children_visits(self):
+    return self.root.children_visits
+
+  def select(self, game, c_puct, root_child=None):
+    return select(self.root, game, c_puct, root_child)
+
+  def expand(self, leaf, children_actions, children_priors):
+    expand(leaf, children_actions, children_priors)
+
+  def backpropagate(self, leaf, game, result):
+    backpropagate(leaf, game, result)
+
+  def update(self, leaf, game, result):
+    update(leaf, game, result)
+
+  def add_virtual_loss(self, leaf, virtual_loss):
+    add_virtual_loss(leaf, virtual_loss)
+
+  def revert_virtual_loss(self, leaf, virtual_loss):
+    revert_virtual_loss(leaf, virtual_loss)
+
+  def is_expanded(self, leaf):
+    return leaf.children is not None
+
+  def depth(self, leaf):
+    return get_depth(leaf)
+
+
+@njit(cache=True)
+def array_select_jitted(first_child, num_children, priors, visits, values_sum, c_puct, path, root_child=-1):
+  current = 0
+  depth = 0
+  # the first step can be forced, to only search below one of the root children
+  if root_child >= 0:
+    current = first_child[0] + root_child
+    path[0] = current
+    depth = 1
+  while num_children[current] > 0:
+    sqrt_visits = math.sqrt(visits[current])
+    start = first_child[current]
+    best_child, best_score = start, -np.inf
+    for child in range(start, start + num_children[current]):
+      # every child needs at least 1 visit
+      if visits[child] == 0:
+        score = np.inf
+      else:
+        score = values_sum[child] / visits[child] + c_puct * priors[child] * sqrt_visits / (visits[child] + 1)
+      if score > best_score:
+        best_child, best_score = child, score
+    path[depth] = best_child
+    depth += 1
+    current = best_child
+  return depth
+
+
+@njit(cache=True)
+def array_backpropagate_jitted(parents, visits, values_sum, leaf, results):
+  current = leaf
+  for result in results:
+    values_sum[current] += result
+    visits[current] += 1
+    current = parents[current]
+  visits[current] += 1
+
+
+@njit(cache=True)
+def array_virtual_loss_jitted(parents, visits, values_sum, leaf, virtual_loss, count):
+  current = leaf
+  while current > 0:
+    values_sum[current] -= virtual_loss * count
+    visits[current] += count
+    current = parents[current]
+  visits[current] += count
+
+
+@njit(cache=True)
+def array_reroot_jitted(first_child, num_children, new_root):
+  # breadth-first copy order of the subtree below new_root, which keeps siblings contiguous
+  order = np.empty(len(first_child), dtype=np.int32)
+  new_first_child = np.zeros(len(first_child), dtype=np.int32)
+  new_parents = np.full(len(first_child), -1, dtype=np.int32)
+  order[0] = new_root
+  size, head = 1, 0
+  while head < size:
+    node = order[head]
+    if num_children[node] > 0:
+      new_first_child[head] = size
+      for i in range(num_children[node]):
+        order[size + i] = first_child[node] + i
+        new_parents[size + i] = head
+      size += num_children[node]
+    head += 1
+  return order[:size], new_first_child[:size], new_parents[:size]
+
+
+class ArrayTree:
+  # struct-of-arrays tree: node 0 is the root and the children of a node are stored contiguously
+  # starting at first_child, so a node costs 28 bytes instead of a Python object
+  FIELDS = ("parents", "first_child", "num_children", "depths", "actions", "priors", "visits_count", "values_sum")
+  root = 0
+
+  def __init__(self, capacity=1024):
+    self.reset(capacity)
+
+  def reset(self, capacity=None):
+    capacity = capacity or self.capacity
+    self.parents = np.full(capacity, -1, dtype=np.int32)
+    self.first_child = np.zeros(capacity, dtype=np.int32)
+    self.num_children = np.zeros(capacity, dtype=np.int16)
+    self.depths = np.zeros(capacity, dtype=np.int16)
+    self.actions = np.zeros(capacity, dtype=np.int32)
+    self.priors = np.zeros(capacity, dtype=np.float32)
+    self.visits_count = np.zeros(capacity, dtype=np.int32)
+    self.values_sum = np.zeros(capacity, dtype=np.float32)
+    self.path = np.zeros(capacity, dtype=np.int32)
+    self.size = 1
+    self.noisy_root = False
+
+  def advance(self, action):
+    # keep the statistics of the subtree below the played action and drop everything else
+    children = self._children(0)
+    matches = np.flatnonzero(self.actions[children] == action)
+    if len(matches) == 0:
+      self.reset()
+      return
+    order, first_child, parents = array_reroot_jitted(self.first_child, self.num_children, children.start + matches[0])
+    size = len(order)
+    for name in ("num_children", "depths", "actions", "priors", "visits_count", "values_sum"):
+      array = getattr(self, name)
+      array[:size] = array[order]
+      array[size : self.size] = 0
+    self.depths[:size] -= self.depths[0]
+    self.first_child[:size] = first_child
+    self.first_child[size : self.size] = 0
+    self.parents[:size] = parents
+    self.parents[size : self.size] = -1
+    self.size = size
+    self.noisy_root = False
+
+  def __len__(self):
+    return self.size
+
+  @property
+  def capacity(self):
+    return len(self.parents)
+
+  @property
+  def nbytes(self):
+    return sum(getattr(self, name).nbytes for name in self.FIELDS)
+
+  def _grow(self, min_capacity):
+    capacity = self.capacity
+    while capacity < min_capacity:
+      capacity *= 2
+    for name in self.FIELDS + ("path",):
+      old = getattr(self, name)
+      new = np.full(capacity, -1, dtype=old.dtype) if name == "parents" else np.zeros(capacity, dtype=old.dtype)
+      new[: len(old)] = old
+      setattr(self, name, new)
+
+  def _children(self, node):
+    start = self.first_child[node]
+    return slice(start, start + self.num_children[node])
+
+  @property
+  def visits(self):
+    return self.visits_count[0]
+
+  @property
+  def children(self):
+    return range(self.num_children[0])
+
+  @property
+  def children_actions(self):
+    return self.actions[self._children(0)]
+
+  @property
+  def children_priors(self):
+    return self.priors[self._children(0)]
+
+  @children_priors.setter
+  def children_priors(self, x):
+    self.priors[self._children(0)] = x
+
+  @property
+  def children_values(self):
+    children = self._children(0)
+    return self.values_sum[children] / np.maximum(self.visits_count[children], 1)
+
+  @property
+  def children_visits(self):
+    return self.visits_count[self._children(0)]
+
+  def select(self, game, c_puct, root_child=None):
+    depth = array_select_jitted(
+      self.first_child,
+      self.num_children,
+      self.priors,
+      self.visits_count,
+      self.values_sum,
+      c_puct,
+      self.path,
+      -1 if root_child is None else root_child,
     )
-  expand(root, game.get_legal_actions(), children_priors)
+    for action in self.actions[self.path[:depth]]:
+      game.step(action)
+    return self.path[depth - 1] if depth > 0 else 0
 
-  for _ in range(iterations):
-    leaf = select(root, game, c_puct)
-    result = game.get_first_person_result()
+  def expand(self, leaf, children_actions, children_priors):
+    n = len(children_actions)
+    if self.size + n > self.capacity:
+      self._grow(self.size + n)
+    children = slice(self.size, self.size + n)
+    self.parents[children] = leaf
+    self.depths[children] = self.depths[leaf] + 1
+    self.actions[children] = children_actions
+    self.priors[children] = children_priors
+    self.first_child[leaf] = self.size
+    self.num_children[leaf] = n
+    self.size += n
+
+  def backpropagate(self, leaf, game, result):
+    self.update(leaf, game, result)
+    for _ in range(self.depths[leaf]):
+      game.undo_last_action()
+
+  def update(self, leaf, game, result):
+    # different games might have different result representations
+    results = np.empty(self.depths[leaf], dtype=np.float32)
+    for i in range(len(results)):
+      result = game.swap_result(result)
+      results[i] = result
+    array_backpropagate_jitted(self.parents, self.visits_count, self.values_sum, leaf, results)
+
+  def add_virtual_loss(self, leaf, virtual_loss):
+    array_virtual_loss_jitted(self.parents, self.visits_count, self.values_sum, leaf, virtual_loss, 1)
+
+  def revert_virtual_loss(self, leaf, virtual_loss):
+    array_virtual_loss_jitted(self.parents, self.visits_count, self.values_sum, leaf, virtual_loss, -1)
+
+  def is_expanded(self, leaf):
+    return self.num_children[leaf] > 0
+
+  def depth(self, leaf):
+    return self.depths[leaf]
+
+
+class SearchBudget:
+  # a search stops when it runs out of iterations or time, or, with early_stop, as soon as the most visited root
+  # child can't be overtaken in the iterations left
+  def __init__(self, iterations, time_budget_ms=None, early_stop=False):
+    self.iterations = iterations
+    self.deadline = time.perf_counter() + time_budget_ms / 1000 if time_budget_ms else None
+    self.early_stop = early_stop
+    self.simulations = 0
+
+  @property
+  def remaining(self):
+    return math.inf if self.iterations is None else self.iterations - self.simulations
+
+  def exhausted(self, tree):
+    if self.simulations >= (math.inf if self.iterations is None else self.iterations):
+      return True
+    if self.deadline is not None and time.perf_counter() >= self.deadline:
+      return True
+    if self.early_stop and self.iterations is not None and len(tree.children_visits) > 1:
+      runner_up, leader = np.partition(tree.children_visits, -2)[-2:]
+      return leader - runner_up > self.remaining
+    return False
+
+
+@njit(cache=True)
+def negamax_backpropagate_jitted(parents, visits, values_sum, leaf, result):
+  current = leaf
+  while current > 0:
+    result = -result
+    values_sum[current] += result
+    visits[current] += 1
+    current = parents[current]
+  visits[current] += 1
+
+
+@njit(cache=True)
+def expand_jitted(
+  parents, first_child, num_children, depths, actions, priors, size, leaf, children_actions, children_priors
+):
+  n = len(children_actions)
+  first_child[leaf] = size
+  num_children[leaf] = n
+  for i in range(n):
+    parents[size + i] = leaf
+    depths[size + i] = depths[leaf] + 1
+    actions[size + i] = children_actions[i]
+    priors[size + i] = children_priors[i]
+  return size + n
+
+
+@njit(cache=True)
+def random_rollout_jitted(state, legal_fn, step_fn, undo_fn, result_fn, legal_buffer, actions_buffer):
+  # plays random moves until the end of the game, then takes them back
+  depth = 0
+  result = result_fn(state)
+  while np.isnan(result):
+    action = legal_buffer[np.random.randint(legal_fn(state, legal_buffer))]
+    step_fn(state, action)
+    actions_buffer[depth] = action
+    depth += 1
+    result = result_fn(state)
+  for i in range(depth - 1, -1, -1):
+    undo_fn(state, actions_buffer[i])
+  # the result is seen by the player to move at the end of the rollout
+  return result if depth % 2 == 0 else -result
+
+
+@njit(cache=True)
+def random_rollouts_jitted(state, num_rollouts, legal_fn, step_fn, undo_fn, result_fn, legal_buffer, actions_buffer):
+  total = 0.0
+  for _ in range(num_rollouts):
+    total += random_rollout_jitted(state, legal_fn, step_fn, undo_fn, result_fn, legal_buffer, actions_buffer)
+  return total / num_rollouts
+
+
+def random_rollouts(game, num_rollouts=1):
+  # mean result of random playouts from the current position, seen by the player to move. Games with an array state
+  # play them in a jitted loop, the others play them on the game itself and take the moves back, instead of copying it
+  if hasattr(game, "ARRAY_FUNCTIONS"):
+    legal_fn, step_fn, undo_fn, result_fn, _ = game.ARRAY_FUNCTIONS
+    state = game.to_array_state()
+    legal_buffer = np.empty(game.action_space, dtype=np.int64)
+    actions_buffer = np.empty(len(state) + game.action_space, dtype=np.int64)
+    return random_rollouts_jitted(
+      state, num_rollouts, legal_fn, step_fn, undo_fn, result_fn, legal_buffer, actions_buffer
+    )
+
+  total = 0.0
+  for _ in range(num_rollouts):
+    depth = 0
+    while (result := game.get_first_person_result()) is None:
+      legal_actions = game.get_legal_actions()
+      game.step(legal_actions[np.random.randint(len(legal_actions))])
+      depth += 1
+    for _ in range(depth):
+      game.undo_last_action()
+      result = game.swap_result(result)
+    total += result
+  return total / num_rollouts
+
+
+# nogil lets root parallel searches run their kernels on several threads at once
+@njit(cache=True, nogil=True)
+def compiled_simulations_jitted(
+  parents,
+  first_child,
+  num_children,
+  depths,
+  actions,
+  priors,
+  visits,
+  values_sum,
+  path,
+  size,
+  state,
+  legal_fn,
+  step_fn,
+  undo_fn,
+  result_fn,
+  observation_fn,
+  c_puct,
+  virtual_loss,
+  simulations,
+  action_space,
+  rollouts,
+  pending_leaves,
+  pending_actions,
+  pending_num_actions,
+  pending_observations,
+):
+  # runs simulations until either the budget is spent, the batch of leaves to evaluate is full or the tree is
+  # out of capacity, and returns the number of simulations run, the new tree size and the number of pending leaves
+  legal_buffer = np.empty(action_space, dtype=np.int64)
+  actions_buffer = np.empty(len(state) + action_space, dtype=np.int64)
+  num_pending = 0
+  done = 0
+  while done < simulations and num_pending < len(pending_leaves) and size + action_space <= len(parents):
+    depth = array_select_jitted(first_child, num_children, priors, visits, values_sum, c_puct, path)
+    for i in range(depth):
+      step_fn(state, actions[path[i]])
+    leaf = path[depth - 1] if depth > 0 else 0
+
+    result = result_fn(state)
+    if np.isnan(result):
+      n = legal_fn(state, legal_buffer)
+      if rollouts > 0:
+        if num_children[leaf] == 0:
+          size = expand_jitted(
+            parents,
+            first_child,
+            num_children,
+            depths,
+            actions,
+            priors,
+            size,
+            leaf,
+            legal_buffer[:n],
+            np.full(n, 1.0 / action_space, dtype=np.float32),
+          )
+        result = random_rollouts_jitted(
+          state, rollouts, legal_fn, step_fn, undo_fn, result_fn, legal_buffer, actions_buffer
+        )
+        negamax_backpropagate_jitted(parents, visits, values_sum, leaf, result)
+      else:
+        pending_leaves[num_pending] = leaf
+        pending_actions[num_pending, :n] = legal_buffer[:n]
+        pending_num_actions[num_pending] = n
+        observation_fn(state, pending_observations[num_pending])
+        array_virtual_loss_jitted(parents, visits, values_sum, leaf, virtual_loss, 1)
+        num_pending += 1
+    else:
+      negamax_backpropagate_jitted(parents, visits, values_sum, leaf, result)
+
+    for i in range(depth - 1, -1, -1):
+      undo_fn(state, actions[path[i]])
+    done += 1
+  return done, size, num_pending
+
+
+@njit(cache=True, nogil=True)
+def compiled_evaluations_jitted(
+  parents,
+  first_child,
+  num_children,
+  depths,
+  actions,
+  priors,
+  visits,
+  values_sum,
+  size,
+  virtual_loss,
+  pending_leaves,
+  pending_actions,
+  pending_num_actions,
+  policies,
+  values,
+):
+  for i in range(len(values)):
+    leaf = pending_leaves[i]
+    array_virtual_loss_jitted(parents, visits, values_sum, leaf, virtual_loss, -1)
+    # the same leaf might have been selected more than once in a batch
+    if num_children[leaf] == 0:
+      children_actions = pending_actions[i, : pending_num_actions[i]]
+      size = expand_jitted(
+        parents,
+        first_child,
+        num_children,
+        depths,
+        actions,
+        priors,
+        size,
+        leaf,
+        children_actions,
+        policies[i][children_actions],
+      )
+    negamax_backpropagate_jitted(parents, visits, values_sum, leaf, values[i])
+  return size
+
+
+# with random rollouts, the budget is checked every COMPILED_SIMULATIONS_PER_CALL simulations
+COMPILED_SIMULATIONS_PER_CALL = 256
+
+
+def compiled_search(tree, game, batch_evaluate_fn, budget, c_puct, batch_size, virtual_loss, rollouts=1):
+  # select, expand and backpropagate run in a single jitted loop on the array state of the game, which only
+  # returns to Python to evaluate a batch of leaves (or never, averaging random rollouts)
+  legal_fn, step_fn, undo_fn, result_fn, observation_fn = game.ARRAY_FUNCTIONS
+  state = game.to_array_state()
+  if batch_evaluate_fn is not None:
+    rollouts = 0
+  pending_leaves = np.empty(batch_size, dtype=np.int64)
+  pending_actions = np.empty((batch_size, game.action_space), dtype=np.int64)
+  pending_num_actions = np.empty(batch_size, dtype=np.int64)
+  pending_observations = np.empty((batch_size, int(np.prod(game.observation_shape))), dtype=np.float32)
+
+  while not budget.exhausted(tree):
+    if tree.size + batch_size * game.action_space > tree.capacity:
+      tree._grow(tree.size + batch_size * game.action_space)
+    done, tree.size, num_pending = compiled_simulations_jitted(
+      tree.parents,
+      tree.first_child,
+      tree.num_children,
+      tree.depths,
+      tree.actions,
+      tree.priors,
+      tree.visits_count,
+      tree.values_sum,
+      tree.path,
+      tree.size,
+      state,
+      legal_fn,
+      step_fn,
+      undo_fn,
+      result_fn,
+      observation_fn,
+      c_puct,
+      virtual_loss,
+      min(budget.remaining, COMPILED_SIMULATIONS_PER_CALL),
+      game.action_space,
+      rollouts,
+      pending_leaves,
+      pending_actions,
+      pending_num_actions,
+      pending_observations,
+    )
+    budget.simulations += done
+    if num_pending:
+      observations = pending_observations[:num_pending].reshape(num_pending, *game.observation_shape)
+      policies, values = batch_evaluate_fn(observations)
+      tree.size = compiled_evaluations_jitted(
+        tree.parents,
+        tree.first_child,
+        tree.num_children,
+        tree.depths,
+        tree.actions,
+        tree.priors,
+        tree.visits_count,
+        tree.values_sum,
+        tree.size,
+        virtual_loss,
+        pending_leaves,
+        pending_actions,
+        pending_num_actions,
+        np.asarray(policies, dtype=np.float32),
+        np.asarray(values, dtype=np.float32),
+      )
+
+
+TREE_BACKENDS = {"nodes": NodeTree, "array": ArrayTree, "compiled": ArrayTree}
+
+
+class Transposition:
+  __slots__ = ("children_actions", "children_priors", "network_value", "visits", "values_sum")
+
+  def __init__(self, children_actions, children_priors, network_value):
+    self.children_actions = children_actions
+    self.children_priors = children_priors
+    self.network_value = network_value
+    self.visits = 0
+    self.values_sum = 0.0
+
+  @property
+  def value(self):
+    # mean of every result backed up through this position, from the point of view of the player to move
+    return self.values_sum / self.visits if self.visits else self.network_value
+
+
+class TranspositionTable:
+  # evaluations and statistics shared by all the paths that reach the same position hash, with LRU eviction
+  def __init__(self, max_size=100_000):
+    self.max_size = max_size
+    self.entries = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def __len__(self):
+    return len(self.entries)
+
+  @property
+  def hit_rate(self):
+    lookups = self.hits + self.misses
+    return self.hits / lookups if lookups else 0.0
+
+  def clear(self):
+    self.entries.clear()
+
+  def get(self, key):
+    entry = self.entries.get(key)
+    if entry is None:
+      self.misses += 1
+      return None
+    self.entries.move_to_end(key)
+    self.hits += 1
+    return entry
+
+  def put(self, key, children_actions, children_priors, network_value):
+    entry = self.entries[key] = Transposition(children_actions, children_priors, network_value)
+    if len(self.entries) > self.max_size:
+      self.entries.popitem(last=False)
+      self.evictions += 1
+    return entry
+
+  def evaluate(self, game, evaluate_fn):
+    key = game.position_hash
+    entry = self.get(key)
+    if entry is None:
+      children_actions = game.get_legal_actions()
+      policy, value = evaluate_fn(game)
+      entry = self.put(key, children_actions, policy[children_actions], value)
+    return entry
+
+  def update(self, hashes, game, result):
+    # hashes go from the leaf up to the root
+    for key in hashes:
+      entry = self.entries.get(key)
+      if entry is not None:
+        entry.visits += 1
+        entry.values_sum += result
+      result = game.swap_result(result)
+
+
+def rewind(game, depth, collect_hashes=False):
+  # undo the selected path, optionally collecting the position hashes from the leaf up to the root
+  hashes = [] if collect_hashes else None
+  for _ in range(depth):
+    if collect_hashes:
+      hashes.append(game.position_hash)
+    game.undo_last_action()
+  if collect_hashes:
+    hashes.append(game.position_hash)
+  return hashes
+
+
+def fuse_agent_fns(value_fn, policy_fn):
+  # agents without a fused evaluation are called twice per position
+  def evaluate_fn(game):
+    return policy_fn(game), value_fn(game)
+
+  return evaluate_fn
+
+
+def simulate(tree, game, evaluate_fn, c_puct, transpositions=None, root_child=None):
+  leaf = tree.select(game, c_puct, root_child)
+  result = game.get_first_person_result()
+  if transpositions is not None:
+    # terminal results are shared too, or the positions on the path would only ever average network values
     if result is None:
+      entry = transpositions.evaluate(game, evaluate_fn)
+      tree.expand(leaf, entry.children_actions, entry.children_priors)
+      result = entry.value
+    tree.update(leaf, game, result)
+    transpositions.update(rewind(game, tree.depth(leaf), collect_hashes=True), game, result)
+    return
+  if result is None:
+    children_actions = game.get_legal_actions()
+    policy, result = evaluate_fn(game)
+    tree.expand(leaf, children_actions, policy[children_actions])
+  tree.backpropagate(leaf, game, result)
+
+
+def search_sequential(tree, game, evaluate_fn, budget, c_puct, transpositions=None):
+  while not budget.exhausted(tree):
+    budget.simulations += 1
+    simulate(tree, game, evaluate_fn, c_puct, transpositions)
+
+
+def search_batched(tree, game, batch_evaluate_fn, budget, c_puct, batch_size, virtual_loss, transpositions=None):
+  while not budget.exhausted(tree):
+    # select up to batch_size leaves, steering away from the ones already pending with a virtual loss
+    pending, observations = [], []
+    for _ in range(min(batch_size, budget.remaining)):
+      leaf = tree.select(game, c_puct)
+      result = game.get_first_person_result()
+      if result is not None:
+        tree.update(leaf, game, result)
+        hashes = rewind(game, tree.depth(leaf), transpositions is not None)
+        if transpositions is not None:
+          transpositions.update(hashes, game, result)
+      elif transpositions is not None and (entry := transpositions.get(game.position_hash)) is not None:
+        # a transposition of an already evaluated position doesn't need the network
+        if not tree.is_expanded(leaf):
+          tree.expand(leaf, entry.children_actions, entry.children_priors)
+        tree.update(leaf, game, entry.value)
+        transpositions.update(rewind(game, tree.depth(leaf), collect_hashes=True), game, entry.value)
+      else:
+        children_actions = game.get_legal_actions()
+        observations.append(game.to_observation())
+        tree.add_virtual_loss(leaf, virtual_loss)
+        pending.append((leaf, children_actions, rewind(game, tree.depth(leaf), transpositions is not None)))
+      budget.simulations += 1
+
+    if pending:
+      policies, values = batch_evaluate_fn(np.stack(observations))
+      for (leaf, children_actions, hashes), policy, value in zip(pending, policies, values):
+        tree.revert_virtual_loss(leaf, virtual_loss)
+        # the same leaf might have been selected more than once in a batch
+        if not tree.is_expanded(leaf):
+          tree.expand(leaf, children_actions, policy[children_actions])
+        tree.update(leaf, game, value)
+        if transpositions is not None:
+          if hashes[0] not in transpositions.entries:
+            transpositions.put(hashes[0], children_actions, policy[children_actions], value)
+          transpositions.update(hashes, game, value)
+
+
+def search_tree_parallel(tree, game, evaluate_fn, budget, c_puct, virtual_loss, num_threads):
+  # the threads share the tree, which is only touched under the lock, while the leaves are evaluated concurrently.
+  # Each thread walks its own copy of the game
+  lock = threading.Lock()
+
+  def worker(game):
+    while True:
+      with lock:
+        if budget.exhausted(tree):
+          return
+        budget.simulations += 1
+        leaf = tree.select(game, c_puct)
+        depth = tree.depth(leaf)
+        result = game.get_first_person_result()
+        if result is None:
+          tree.add_virtual_loss(leaf, virtual_loss)
+        else:
+          tree.update(leaf, game, result)
+
+      if result is None:
+        children_actions = game.get_legal_actions()
+        policy, result = evaluate_fn(game)
+        children_priors = policy[children_actions]
+        with lock:
+          tree.revert_virtual_loss(leaf, virtual_loss)
+          # another thread might have expanded the same leaf in the meantime
+          if not tree.is_expanded(leaf):
+            tree.expand(leaf, children_actions, children_priors)
+          tree.update(leaf, game, result)
+      rewind(game, depth)
+
+  with ThreadPoolExecutor(num_threads) as executor:
+    for future in [executor.submit(worker, copy.deepcopy(game)) for _ in range(num_threads)]:
+      future.result()
+
+
+class MergedRoots:
+  # root statistics of independent trees searched from the same position
+  def __init__(self, trees):
+    self.trees = trees
+    self.children_actions = trees[0].children_actions
+    self.children_priors = trees[0].children_priors
+    self.children_visits = sum(np.asarray(tree.children_visits) for tree in trees)
+    values_sums = sum(np.asarray(tree.children_values) * np.asarray(tree.children_visits) for tree in trees)
+    self.children_values = values_sums / np.maximum(self.children_visits, 1)
+    self.visits = sum(tree.visits for tree in trees)
+    self.simulations = sum(tree.simulations for tree in trees)
+
+
+def search_root_parallel(game, value_fn, policy_fn, iterations, num_threads, **search_kwargs):
+  # the iterations are split between independent trees, each searched by its own thread on its own copy of the game
+  with ThreadPoolExecutor(num_threads) as executor:
+    futures = [
+      executor.submit(
+        search,
+        copy.deepcopy(game),
+        value_fn,
+        policy_fn,
+        None if iterations is None else iterations // num_threads + (i < iterations % num_threads),
+        **search_kwargs,
+      )
+      for i in range(num_threads)
+    ]
+    return MergedRoots([future.result() for future in futures])
+
+
+def add_dirichlet_noise(tree, dirichlet_alpha):
+  # the root is expanded before searching, so that there's no need to check if it's necessary to add
+  # dirichlet noise at every iteration of the search loop
+  if dirichlet_alpha and not tree.noisy_root:
+    children_priors = tree.children_priors
+    tree.children_priors = 0.75 * children_priors + 0.25 * np.random.default_rng().dirichlet(
+      dirichlet_alpha * np.ones_like(children_priors)
+    )
+    tree.noisy_root = True
+
+
+def search(
+  game,
+  value_fn,
+  policy_fn,
+  iterations,
+  c_puct=1.0,
+  dirichlet_alpha=None,
+  backend="nodes",
+  batch_size=1,
+  batch_evaluate_fn=None,
+  virtual_loss=1.0,
+  tree=None,
+  transpositions=None,
+  parallel=None,
+  num_threads=1,
+  time_budget_ms=None,
+  early_stop=False,
+  evaluate_fn=None,
+  rollouts=1,
+):
+  # iterations can be None to search until the time budget runs out. The returned tree records how many
+  # simulations were actually run in its simulations attribute. evaluate_fn(game) -> (policy, value), when given,
+  # replaces value_fn and policy_fn, evaluating each position at once
+  if iterations is None and not time_budget_ms:
+    raise ValueError("A search needs a number of iterations, a time budget or both")
+  if parallel == "root":
+    if tree is not None or transpositions is not None:
+      raise ValueError("Root parallel searches don't support trees reuse nor transpositions")
+    return search_root_parallel(
+      game,
+      value_fn,
+      policy_fn,
+      iterations,
+      num_threads,
+      c_puct=c_puct,
+      dirichlet_alpha=dirichlet_alpha,
+      backend=backend,
+      batch_size=batch_size,
+      batch_evaluate_fn=batch_evaluate_fn,
+      virtual_loss=virtual_loss,
+      time_budget_ms=time_budget_ms,
+      early_stop=early_stop,
+      evaluate_fn=evaluate_fn,
+      rollouts=rollouts,
+    )
+  if parallel == "tree" and (backend == "compiled" or batch_size > 1 or transpositions is not None):
+    raise ValueError("Tree parallel searches only support the nodes and array backends, without batching")
+
+  # without a batch_evaluate_fn the compiled backend evaluates leaves with the mean of rollouts random rollouts
+  if batch_size > 1 and batch_evaluate_fn is None and backend != "compiled":
+    raise ValueError("batch_evaluate_fn is needed to search with batch_size > 1")
+  if backend == "compiled" and transpositions is not None:
+    raise ValueError("The compiled backend doesn't support transpositions")
+
+  # a tree carried over from the previous move already holds the statistics of the current position
+  if tree is None:
+    tree = TREE_BACKENDS[backend]()
+  if not tree.is_expanded(tree.root):
+    if transpositions is not None:
+      # the root is shared like any other position, so it needs a value as well
+      entry = transpositions.evaluate(game, evaluate_fn or fuse_agent_fns(value_fn, policy_fn))
+      tree.expand(tree.root, entry.children_actions, entry.children_priors)
+    else:
       children_actions = game.get_legal_actions()
-      children_priors = policy_fn(game)[children_actions]
-      expand(leaf, children_actions, children_priors)
-      result = value_fn(game)
-    backpropagate(leaf, game, result)
-  return root
+      # the root only needs a policy, so agents without a fused evaluation don't run their value_fn for it
+      policy = policy_fn(game) if evaluate_fn is None else evaluate_fn(game)[0]
+      tree.expand(tree.root, children_actions, policy[children_actions])
+  add_dirichlet_noise(tree, dirichlet_alpha)
+
+  if evaluate_fn is None:
+    evaluate_fn = fuse_agent_fns(value_fn, policy_fn)
+
+  budget = SearchBudget(iterations, time_budget_ms=time_budget_ms, early_stop=early_stop)
+  if backend == "compiled":
+    compiled_search(tree, game, batch_evaluate_fn, budget, c_puct, batch_size, virtual_loss, rollouts)
+  elif batch_size > 1:
+    search_batched(tree, game, batch_evaluate_fn, budget, c_puct, batch_size, virtual_loss, transpositions)
+  elif parallel == "tree":
+    search_tree_parallel(tree, game, evaluate_fn, budget, c_puct, virtual_loss, num_threads)
+  else:
+    search_sequential(tree, game, evaluate_fn, budget, c_puct, transpositions)
+  tree.simulations = budget.simulations
+  return tree
+
+
+def search_lockstep(games, trees, batch_evaluate_fn, iterations, c_puct=1.0, dirichlet_alpha=None):
+  # one search per game, all run in lockstep: every iteration selects a leaf in each tree and evaluates all of them
+  # with a single call to batch_evaluate_fn, so the network sees batches as large as the number of games
+  unexpanded = [i for i, tree in enumerate(trees) if not tree.is_expanded(tree.root)]
+  if unexpanded:
+    policies, _ = batch_evaluate_fn(np.stack([games[i].to_observation() for i in unexpanded]))
+    for i, policy in zip(unexpanded, policies):
+      children_actions = games[i].get_legal_actions()
+      trees[i].expand(trees[i].root, children_actions, policy[children_actions])
+  for tree in trees:
+    add_dirichlet_noise(tree, dirichlet_alpha)
+
+  for _ in range(iterations):
+    pending, observations = [], []
+    for tree, game in zip(trees, games):
+      leaf = tree.select(game, c_puct)
+      result = game.get_first_person_result()
+      if result is None:
+        pending.append((tree, game, leaf, game.get_legal_actions()))
+        observations.append(game.to_observation())
+      else:
+        tree.backpropagate(leaf, game, result)
+
+    if pending:
+      policies, values = batch_evaluate_fn(np.stack(observations))
+      for (tree, game, leaf, children_actions), policy, value in zip(pending, policies, values):
+        tree.expand(leaf, children_actions, policy[children_actions])
+        tree.backpropagate(leaf, game, value)
+
+  for tree in trees:
+    tree.simulations = iterations
+  return trees
+
+
+def completed_q_values(tree, root_value):
+  # the values of the unvisited root children are completed with a mix of the root value and the prior-weighted
+  # mean of the visited ones, then all of them are rescaled to [0, 1]
+  children_values = np.asarray(tree.children_values, dtype=np.float64)
+  children_visits = np.asarray(tree.children_visits)
+  children_priors = np.asarray(tree.children_priors, dtype=np.float64)
+  visited = children_visits > 0
+  mixed_value = root_value
+  if visited.any():
+    visits_sum = children_visits.sum()
+    visited_priors = children_priors[visited]
+    weighted_value = (visited_priors * children_values[visited]).sum() / max(visited_priors.sum(), 1e-12)
+    mixed_value = (root_value + visits_sum * weighted_value) / (1 + visits_sum)
+  completed = np.where(visited, children_values, mixed_value)
+  low, high = completed.min(), completed.max()
+  return (completed - low) / max(high - low, 1e-8)
+
+
+def gumbel_search(
+  game,
+  value_fn,
+  policy_fn,
+  iterations,
+  max_considered_actions=16,
+  c_visit=50.0,
+  c_scale=1.0,
+  c_puct=1.0,
+  backend="nodes",
+  tree=None,
+  evaluate_fn=None,
+):
+  # Gumbel root selection (Danihelka et al., "Policy improvement by planning with Gumbel"): the Gumbel top-k trick
+  # samples without replacement the max_considered_actions most promising root children, then sequential halving
+  # splits the iterations between them. Below the root the search is the usual PUCT one. The returned tree holds
+  # the chosen action in selected_action and the completed-Q improved policy over the root children in
+  # improved_policy, which is a better policy target than the visits distribution when simulations are few
+  if backend == "compiled":
+    raise ValueError("Gumbel searches only support the nodes and array backends")
+  if tree is None:
+    tree = TREE_BACKENDS[backend]()
+  if evaluate_fn is None:
+    evaluate_fn = fuse_agent_fns(value_fn, policy_fn)
+  policy, root_value = evaluate_fn(game)
+  if not tree.is_expanded(tree.root):
+    children_actions = game.get_legal_actions()
+    tree.expand(tree.root, children_actions, policy[children_actions])
+
+  logits = np.log(np.maximum(np.asarray(tree.children_priors, dtype=np.float64), 1e-12))
+  gumbel = np.random.default_rng().gumbel(size=len(logits))
+
+  def transformed_q_values():
+    return (c_visit + np.max(tree.children_visits)) * c_scale * completed_q_values(tree, root_value)
+
+  # every considered action must be visited at least once, or its completed Q could win the halving unsearched
+  considered = np.argsort(-(gumbel + logits))[: min(max_considered_actions, iterations, len(logits))]
+  num_phases = max(1, math.ceil(math.log2(len(considered))))
+  simulations = 0
+  for phase in range(num_phases):
+    if phase < num_phases - 1:
+      visits_per_action = max(1, iterations // (num_phases * len(considered)))
+    else:
+      # the last phase spends whatever is left of the iterations
+      visits_per_action = max(1, math.ceil((iterations - simulations) / len(considered)))
+    for _ in range(visits_per_action):
+      for root_child in considered:
+        if simulations < iterations:
+          simulate(tree, game, evaluate_fn, c_puct, root_child=root_child)
+          simulations += 1
+    scores = gumbel[considered] + logits[considered] + transformed_q_values()[considered]
+    considered = considered[np.argsort(-scores)][: math.ceil(len(considered) / 2)]
+
+  improved_logits = logits + transformed_q_values()
+  improved_policy = np.exp(improved_logits - improved_logits.max())
+  tree.improved_policy = (improved_policy / improved_policy.sum()).astype(np.float32)
+  tree.selected_action = tree.children_actions[considered[0]]
+  tree.simulations = simulations
+  return tree
 
 
-def play(game, agent, search_iterations, c_puct=1.0, dirichlet_alpha=None):
-  root = search(
-    game, agent.value_fn, agent.policy_fn, search_iterations, c_puct=c_puct, dirichlet_alpha=dirichlet_alpha
+def play(
+  game,
+  agent,
+  search_iterations,
+  c_puct=1.0,
+  dirichlet_alpha=None,
+  backend="nodes",
+  batch_size=1,
+  tree=None,
+  transpositions=None,
+  parallel=None,
+  num_threads=1,
+  time_budget_ms=None,
+  early_stop=False,
+):
+  tree = search(
+    game,
+    agent.value_fn,
+    agent.policy_fn,
+    search_iterations,
+    c_puct=c_puct,
+    dirichlet_alpha=dirichlet_alpha,
+    backend=backend,
+    batch_size=batch_size,
+    batch_evaluate_fn=getattr(agent, "evaluate_observations", None),
+    evaluate_fn=getattr(agent, "evaluate", None),
+    rollouts=getattr(agent, "rollouts", 1),
+    tree=tree,
+    transpositions=transpositions,
+    parallel=parallel,
+    num_threads=num_threads,
+    time_budget_ms=time_budget_ms,
+    early_stop=early_stop,
   )
-  return root.children_actions[np.argmax(root.children_visits)]
+  return tree.children_actions[np.argmax(tree.children_visits)]
 
 
-def pit(game, agent1, agent2, agent1_play_kwargs, agent2_play_kwargs):
+def pit(game, agent1, agent2, agent1_play_kwargs, agent2_play_kwargs, reuse_trees=False):
   current_agent, other_agent = agent1, agent2
   current_agent_play_kwargs, other_agent_play_kwargs = agent1_play_kwargs, agent2_play_kwargs
+  current_tree, other_tree = None, None
+  if reuse_trees:
+    current_tree = TREE_BACKENDS[agent1_play_kwargs.get("backend", "nodes")]()
+    other_tree = TREE_BACKENDS[agent2_play_kwargs.get("backend", "nodes")]()
   while (result := game.get_result()) is None:
-    action = play(game, current_agent, **current_agent_play_kwargs)
+    action = play(game, current_agent, tree=current_tree, **current_agent_play_kwargs)
     game.step(action)
+    if reuse_trees:
+      current_tree.advance(action)
+      other_tree.advance(action)
     current_agent, other_agent = other_agent, current_agent
     current_agent_play_kwargs, other_agent_play_kwargs = other_agent_play_kwargs, current_agent_play_kwargs
+    current_tree, other_tree = other_tree, current_tree
   return result
@@ -1,3 +1,4 @@
+import copy
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -24,7 +25,7 @@ class LinearNetwork(nn.Module):
 
   def value_forward(self, observation):
     self.eval()
-    with torch.no_grad():
+    with torch.inference_mode():
       x = F.relu(self.first_layer(observation))
       x = F.relu(self.second_layer(x))
       value = F.tanh(self.value_head(x))
@@ -32,12 +33,21 @@ class LinearNetwork(nn.Module):
 
   def policy_forward(self, observation):
     self.eval()
-    with torch.no_grad():
+    with torch.inference_mode():
       x = F.relu(self.first_layer(observation))
       x = F.relu(self.second_layer(x))
       log_policy = F.softmax(self.policy_head(x), dim=-1)
       return log_policy
 
+  def predict(self, observations):
+    self.eval()
+    with torch.inference_mode():
+      x = F.relu(self.first_layer(observations))
+      x = F.relu(self.second_layer(x))
+      policy = F.softmax(self.policy_head(x), dim=-1)
+      value = F.tanh(self.value_head(x))
+      return policy, value
+
 
 class TicTacToe2DNetwork(nn.Module):
   def __init__(self, input_shape, action_space, first_linear_size=512, second_linear_size=256):
@@ -69,7 +79,7 @@ class TicTacToe2DNetwork(nn.Module):
 
   def value_forward(self, observation):
     self.eval()
-    with torch.no_grad():
+    with torch.inference_mode():
       x = F.relu(self.conv1(observation))
       x = F.relu(self.conv2(x))
       x = F.relu(self.conv3(x))
@@ -77,11 +87,11 @@ class TicTacToe2DNetwork(nn.Module):
       x = F.relu(self.fc1(x))
       x = F.relu(self.fc2(x))
       value = F.tanh(self.value_head(x))
-      return value[0]
+      return value if observation.dim() == 4 else value[0]
 
   def policy_forward(self, observation):
     self.eval()
-    with torch.no_grad():
+    with torch.inference_mode():
       x = F.relu(self.conv1(observation))
       x = F.relu(self.conv2(x))
       x = F.relu(self.conv3(x))
@@ -89,4 +99,85 @@ class TicTacToe2DNetwork(nn.Module):
       x = F.relu(self.fc1(x))
       x = F.relu(self.fc2(x))
       log_policy = F.softmax(self.policy_head(x), dim=-1)
-      return log_policy[0]
+      return log_policy if observation.dim() == 4 else log_policy[0]
+
+  def predict(self, observations):
+    self.eval()
+    with torch.inference_mode():
+      x = F.relu(self.conv1(observations))
+      x = F.relu(self.conv2(x))
+      x = F.relu(self.conv3(x))
+      x = x.view(-1, 3 * 3 * 64)
+      x = F.relu(self.fc1(x))
+      x = F.relu(self.fc2(x))
+      policy = F.softmax(self.policy_head(x), dim=-1)
+      value = F.tanh(self.value_head(x))
+      return (policy, value) if observations.dim() == 4 else (policy[0], value[0])
+
+
+class PredictModule(nn.Module):
+  # exposes the predict method of a model as forward, so that it can be traced
+  def __init__(self, model):
+    super().__init__()
+    self.model = model
+
+  def forward(self, observations):
+    return self.model.predict(observations)
+
+
+class InferenceModel:
+  # inference-only TorchScript export of a model, which can be used by the agents in place of the model it was
+  # exported from. It always runs on CPU, and batches single observations itself
+  def __init__(self, module, observation_dims):
+    self.module = module
+    self.observation_dims = observation_dims
+    self.device = torch.device("cpu")
+
+  @classmethod
+  def export(cls, model, example_observations, quantize=False):
+    # traces model.predict on a batch of example observations, then freezes the result so that the weights become
+    # constants and the layers can be fused. quantize stores the weights of the linear layers in int8, and
+    # quantizes their activations on the fly
+    model = copy.deepcopy(model).cpu().eval()
+    if quantize:
+      model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    with torch.no_grad():
+      module = torch.jit.trace(PredictModule(model).eval(), example_observations.cpu())
+    module = torch.jit.freeze(module)
+    return cls(module, example_observations.dim() - 1)
+
+  def save(self, path):
+    torch.jit.save(self.module, path, _extra_files={"observation_dims": str(self.observation_dims)})
+
+  @classmethod
+  def load(cls, path):
+    extra_files = {"observation_dims": ""}
+    module = torch.jit.load(path, map_location="cpu", _extra_files=extra_files)
+    return cls(module, int(extra_files["observation_dims"]))
+
+  def parameters(self):
+    # the weights are constants of the module, they never change
+    return iter(())
+
+  def predict(self, observations):
+    with torch.inference_mode():
+      if observations.dim() == self.observation_dims:
+        policies, values = self.module(observations.unsqueeze(0))
+        return policies[0], values[0]
+      return self.module(observations)
+
+  def value_forward(self, observation):
+    return self.predict(observation)[1]
+
+  def policy_forward(self, observation):
+    return self.predict(observation)[0]
+
+  def check_accuracy(self, model, observations):
+    # largest absolute differences between the policies and the values of this model and of the model it was
+    # exported from
+    policies, values = model.predict(observations.to(model.device))
+    inference_policies, inference_values = self.predict(observations.cpu())
+    return (
+      (policies.cpu() - inference_policies).abs().max().item(),
+      (values.cpu() - inference_values).abs().max().item(),
+    )
@@ -1,10 +1,176 @@
 import numpy as np
+from numba import njit
+
+LEVEL_SIZES = [4, 3, 2, 1]
+LEVEL_OFFSETS = [0, 16, 25, 29]
+NUM_CELLS = 30
+
+
+def build_supports():
+    # the four cells below every cell above the first level, -1 for the cells of the first level
+    supports = np.full((NUM_CELLS, 4), -1, dtype=np.int64)
+    for lvl in range(1, len(LEVEL_SIZES)):
+        size, below_size = LEVEL_SIZES[lvl], LEVEL_SIZES[lvl - 1]
+        for r in range(size):
+            for c in range(size):
+                below = LEVEL_OFFSETS[lvl - 1] + r * below_size + c
+                supports[LEVEL_OFFSETS[lvl] + r * size + c] = (
+                    below,
+                    below + 1,
+                    below + below_size,
+                    below + below_size + 1,
+                )
+    return supports
+
+
+SUPPORTS = build_supports()
+
+
+def build_covers():
+    # the cells above every cell that rest on it, -1 for the missing ones
+    covers = np.full((NUM_CELLS, 4), -1, dtype=np.int64)
+    for cell, supports in enumerate(SUPPORTS):
+        for s in supports[supports >= 0]:
+            covers[s, np.argmax(covers[s] < 0)] = cell
+    return covers
+
+
+COVERS = build_covers()
+
+
+def build_squares():
+    # the four cells of every 2x2 square of every level
+    squares = []
+    for offset, size in zip(LEVEL_OFFSETS, LEVEL_SIZES):
+        for r in range(size - 1):
+            for c in range(size - 1):
+                top_left = offset + r * size + c
+                squares.append((top_left, top_left + 1, top_left + size, top_left + size + 1))
+    return squares
+
+
+def build_lines():
+    # the cells of every row and column of the two lowest levels, the only ones where a line lets remove spheres
+    lines = []
+    for offset, size in zip(LEVEL_OFFSETS[:2], LEVEL_SIZES[:2]):
+        grid = offset + np.arange(size * size).reshape(size, size)
+        lines += [tuple(line) for line in np.concatenate([grid, grid.T]).tolist()]
+    return lines
+
+
+def cells_groups(groups):
+    # for every cell, the groups that contain it as the rows of an array
+    return [np.array([group for group in groups if cell in group], dtype=np.int64) for cell in range(NUM_CELLS)]
+
+
+CELL_SQUARES = cells_groups(build_squares())
+CELL_LINES = cells_groups(build_lines())
+
+
+def to_mask(cells):
+    mask = 0
+    for cell in cells:
+        if cell >= 0:
+            mask |= 1 << int(cell)
+    return mask
+
+
+# the same tables as bitmasks of cells, for the incremental masks of PylosGame
+SUPPORT_MASKS = [to_mask(supports) for supports in SUPPORTS]
+COVER_MASKS = [to_mask(covers) for covers in COVERS]
+COVER_LISTS = [[int(cell) for cell in covers if cell >= 0] for covers in COVERS]
+# the cells of the levels above the one of every cell
+HIGHER_LEVELS_MASKS = [
+    (1 << NUM_CELLS) - (1 << LEVEL_OFFSETS[lvl + 1]) if lvl + 1 < len(LEVEL_SIZES) else 0
+    for lvl, size in enumerate(LEVEL_SIZES)
+    for _ in range(size * size)
+]
+
+
+def build_symmetries():
+    # the 4 rotations of the pyramid and of its transpose, as index permutations: the symmetric cells are
+    # cells[permutation]. Every level turns around the same axis, so the supports of a cell turn with it
+    symmetries = []
+    for transpose in (False, True):
+        for k in range(4):
+            levels = []
+            for offset, size in zip(LEVEL_OFFSETS, LEVEL_SIZES):
+                grid = offset + np.arange(size * size).reshape(size, size)
+                levels.append(np.rot90(grid.T if transpose else grid, k).ravel())
+            symmetries.append(np.concatenate(levels))
+    return np.array(symmetries)
+
+
+SYMMETRIES = build_symmetries()
+
+
+# array state: the 30 cells, the player to move and the reserves of white and black
+@njit(cache=True)
+def array_legal_actions(state, out):
+    turn = state[NUM_CELLS]
+    if state[NUM_CELLS + 1 if turn == 1 else NUM_CELLS + 2] <= 0:
+        return 0
+    n = 0
+    for i in range(NUM_CELLS):
+        if state[i] != 0:
+            continue
+        supported = True
+        for s in SUPPORTS[i]:
+            if s >= 0 and state[s] == 0:
+                supported = False
+        if supported:
+            out[n] = i
+            n += 1
+    return n
+
+
+@njit(cache=True)
+def array_step(state, action):
+    turn = state[NUM_CELLS]
+    state[action] = turn
+    state[NUM_CELLS + 1 if turn == 1 else NUM_CELLS + 2] -= 1
+    state[NUM_CELLS] = -turn
+
+
+@njit(cache=True)
+def array_undo(state, action):
+    turn = -state[NUM_CELLS]
+    state[action] = 0
+    state[NUM_CELLS + 1 if turn == 1 else NUM_CELLS + 2] += 1
+    state[NUM_CELLS] = turn
+
+
+@njit(cache=True)
+def array_first_person_result(state):
+    if state[NUM_CELLS - 1] != 0:
+        return float(state[NUM_CELLS - 1] * state[NUM_CELLS])
+    if array_legal_actions(state, np.empty(NUM_CELLS, dtype=np.int64)) == 0:
+        # the player to move is out of moves and loses
+        return -1.0
+    return np.nan
+
+
+@njit(cache=True)
+def array_observation(state, out):
+    for i in range(NUM_CELLS):
+        out[i] = state[i] * state[NUM_CELLS]
 
 
 class PylosGame:
-    """Simple playable version of the board game Pylos."""
+    """Simple playable version of the board game Pylos.
+
+    The pyramid is a flat array of 30 cells, level after level, and board holds a 2D view of each level into it. The
+    occupied cells and the legal placements are also kept as bitmasks, updated by every placement, so that legal
+    actions and results don't need to scan the pyramid.
+    """
 
-    LEVEL_SIZES = [4, 3, 2, 1]
+    LEVEL_SIZES = LEVEL_SIZES
+    # random keys for every (cell, player) pair and for black to move, used for the incremental position hash
+    ZOBRIST_KEYS = np.random.default_rng(0).integers(1, 2**63, size=(NUM_CELLS, 2)).tolist()
+    ZOBRIST_BLACK_TO_MOVE = int(np.random.default_rng(1).integers(1, 2**63))
+    ARRAY_FUNCTIONS = (array_legal_actions, array_step, array_undo, array_first_person_result, array_observation)
+    # the permutations of the observation and of the actions under every symmetry of the pyramid
+    SYMMETRIES = (SYMMETRIES, SYMMETRIES)
 
     def __init__(self):
         # mapping from action index to (level, row, col)
@@ -13,17 +179,36 @@ class PylosGame:
             for r in range(size):
                 for c in range(size):
                     self.index_to_coords.append((lvl, r, c))
+        self.coords_to_index = {coords: idx for idx, coords in enumerate(self.index_to_coords)}
         self.action_space = len(self.index_to_coords)
         self.observation_shape = (self.action_space,)
 
         self.reset()
 
     def reset(self):
-        self.board = [np.zeros((s, s), dtype=int) for s in self.LEVEL_SIZES]
+        self.cells = np.zeros(NUM_CELLS, dtype=np.int8)
+        # views into the cells, so that writing into a level writes into the cells
+        self.board = [
+            self.cells[offset : offset + size * size].reshape(size, size)
+            for offset, size in zip(LEVEL_OFFSETS, self.LEVEL_SIZES)
+        ]
         self.turn = 1  # 1 -> White, -1 -> Black
         self.reserves = {1: 15, -1: 15}
         self.last_move = None
         self.actions_stack = []
+        self.board_hash = 0
+        self.update_masks()
+
+    def update_masks(self):
+        """Rebuild the bitmasks of the occupied cells and of the legal placements from the cells.
+
+        Placements update them incrementally, raises and removals call this.
+        """
+        self.filled = to_mask(np.flatnonzero(self.cells).tolist())
+        self.legal = 0
+        for idx in range(NUM_CELLS):
+            if not self.filled >> idx & 1 and (self.filled & SUPPORT_MASKS[idx]) == SUPPORT_MASKS[idx]:
+                self.legal |= 1 << idx
 
     # -----------------------------------------------------------
     def __str__(self):
@@ -44,41 +229,48 @@ class PylosGame:
             lines.append("")
         return "\n".join(lines)
 
+    # -----------------------------------------------------------
+    @property
+    def position_hash(self):
+        """Zobrist hash of the position.
+
+        Reserves are not hashed since every sphere is either on the board or in its owner's reserve.
+        """
+        if self.turn == -1:
+            return self.board_hash ^ self.ZOBRIST_BLACK_TO_MOVE
+        return self.board_hash
+
+    def toggle_hash(self, level, r, c, player):
+        self.board_hash ^= self.ZOBRIST_KEYS[self.coords_to_index[(level, r, c)]][(1 - player) // 2]
+
     # -----------------------------------------------------------
     def piece_has_top(self, level, r, c):
-        if level >= len(self.board) - 1:
-            return False
-        for dr in (0, -1):
-            for dc in (0, -1):
-                nr = r + dr
-                nc = c + dc
-                if 0 <= nr < self.board[level + 1].shape[0] and 0 <= nc < self.board[level + 1].shape[1]:
-                    if self.board[level + 1][nr, nc] != 0:
-                        return True
-        return False
+        return (self.filled & COVER_MASKS[self.coords_to_index[(level, r, c)]]) != 0
 
     def is_supported(self, level, r, c):
-        if level == 0:
-            return True
-        b = self.board[level - 1]
-        return (
-            b[r, c] != 0
-            and b[r + 1, c] != 0
-            and b[r, c + 1] != 0
-            and b[r + 1, c + 1] != 0
-        )
+        mask = SUPPORT_MASKS[self.coords_to_index[(level, r, c)]]
+        return (self.filled & mask) == mask
 
     # -----------------------------------------------------------
     def place(self, level, r, c):
+        return self.place_index(self.coords_to_index[(level, r, c)])
+
+    def place_index(self, idx):
         if self.reserves[self.turn] <= 0:
             return False
-        if self.board[level][r, c] != 0:
+        if not self.legal >> idx & 1:
             return False
-        if not self.is_supported(level, r, c):
-            return False
-        self.board[level][r, c] = self.turn
+        self.cells[idx] = self.turn
+        self.filled |= 1 << idx
+        # the cell is taken, and the cells above it whose support it completes become legal. They're usually empty,
+        # unless a sphere was raised from under them
+        self.legal &= ~(1 << idx)
+        for above in COVER_LISTS[idx]:
+            if not self.filled >> above & 1 and (self.filled & SUPPORT_MASKS[above]) == SUPPORT_MASKS[above]:
+                self.legal |= 1 << above
+        self.board_hash ^= self.ZOBRIST_KEYS[idx][(1 - self.turn) // 2]
         self.reserves[self.turn] -= 1
-        self.last_move = (level, r, c)
+        self.last_move = self.index_to_coords[idx]
         return True
 
     def raise_piece(self, sl, sr, sc, dl, dr, dc):
@@ -95,41 +287,26 @@ class PylosGame:
         # move
         self.board[sl][sr, sc] = 0
         self.board[dl][dr, dc] = self.turn
+        self.toggle_hash(sl, sr, sc, self.turn)
+        self.toggle_hash(dl, dr, dc, self.turn)
+        self.update_masks()
         self.last_move = (dl, dr, dc)
         return True
 
     # -----------------------------------------------------------
     def check_square(self, level, r, c):
-        layer = self.board[level]
-        player = layer[r, c]
-        if player == 0:
+        idx = self.coords_to_index[(level, r, c)]
+        player = self.cells[idx]
+        if player == 0 or len(CELL_SQUARES[idx]) == 0:
             return False
-        for dr in (0, -1):
-            for dc in (0, -1):
-                rr = r + dr
-                cc = c + dc
-                if rr < 0 or cc < 0 or rr + 1 >= layer.shape[0] or cc + 1 >= layer.shape[1]:
-                    continue
-                sq = layer[rr : rr + 2, cc : cc + 2]
-                if np.all(sq == player):
-                    return True
-        return False
+        return bool((self.cells[CELL_SQUARES[idx]] == player).all(axis=1).any())
 
     def check_line(self, level, r, c):
-        player = self.board[level][r, c]
-        if player == 0:
+        idx = self.coords_to_index[(level, r, c)]
+        player = self.cells[idx]
+        if player == 0 or len(CELL_LINES[idx]) == 0:
             return False
-        if level == 0:
-            if np.all(self.board[level][r, :] == player):
-                return True
-            if np.all(self.board[level][:, c] == player):
-                return True
-        if level == 1:
-            if np.all(self.board[level][r, :] == player):
-                return True
-            if np.all(self.board[level][:, c] == player):
-                return True
-        return False
+        return bool((self.cells[CELL_LINES[idx]] == player).all(axis=1).any())
 
     def check_for_removal(self):
         if not self.last_move:
@@ -147,32 +324,22 @@ class PylosGame:
         if self.piece_has_top(level, r, c):
             return False
         self.board[level][r, c] = 0
+        self.toggle_hash(level, r, c, self.turn)
         self.reserves[self.turn] += 1
+        self.update_masks()
         return True
 
     def top_filled(self):
-        return self.board[-1][0, 0] != 0
+        return self.cells[-1] != 0
 
     # -----------------------------------------------------------
     def has_move(self):
-        if self.reserves[self.turn] > 0:
-            for lvl, layer in enumerate(self.board):
-                for r in range(layer.shape[0]):
-                    for c in range(layer.shape[1]):
-                        if layer[r, c] == 0 and self.is_supported(lvl, r, c):
-                            return True
-        # check for possible raises
-        for sl, layer in enumerate(self.board[:-1]):
-            for r in range(layer.shape[0]):
-                for c in range(layer.shape[1]):
-                    if layer[r, c] == self.turn and not self.piece_has_top(sl, r, c):
-                        for dl in range(sl + 1, len(self.board)):
-                            size = self.board[dl].shape[0]
-                            for dr in range(size):
-                                for dc in range(size):
-                                    if self.board[dl][dr, dc] == 0 and self.is_supported(dl, dr, dc):
-                                        if dl - 1 >= sl:
-                                            return True
+        if self.reserves[self.turn] > 0 and self.legal:
+            return True
+        # check for possible raises: a free sphere can go to any empty and supported cell of a higher level
+        for idx in np.flatnonzero(self.cells[: LEVEL_OFFSETS[-1]] == self.turn).tolist():
+            if not self.filled & COVER_MASKS[idx] and self.legal & HIGHER_LEVELS_MASKS[idx]:
+                return True
         return False
 
     # -----------------------------------------------------------
@@ -181,29 +348,33 @@ class PylosGame:
         if self.reserves[self.turn] <= 0:
             return []
         actions = []
-        for idx, (lvl, r, c) in enumerate(self.index_to_coords):
-            if self.board[lvl][r, c] == 0 and self.is_supported(lvl, r, c):
-                actions.append(idx)
+        legal = self.legal
+        while legal:
+            idx = (legal & -legal).bit_length() - 1
+            actions.append(idx)
+            legal ^= 1 << idx
         return actions
 
     def step(self, action):
-        lvl, r, c = self.index_to_coords[action]
-        if not self.place(lvl, r, c):
+        if not self.place_index(int(action)):
             raise ValueError(f"Illegal action {action}")
         self.actions_stack.append(action)
         self.turn *= -1
 
     def undo_last_action(self):
         self.turn *= -1
-        action = self.actions_stack.pop()
-        lvl, r, c = self.index_to_coords[action]
-        self.board[lvl][r, c] = 0
+        action = int(self.actions_stack.pop())
+        self.cells[action] = 0
+        self.filled ^= 1 << action
+        # the cell was legal before it was taken, and the cells above it lose their support
+        self.legal = (self.legal | 1 << action) & ~COVER_MASKS[action]
+        self.board_hash ^= self.ZOBRIST_KEYS[action][(1 - self.turn) // 2]
         self.reserves[self.turn] += 1
 
     def get_result(self):
-        if self.top_filled():
-            return self.board[-1][0, 0]
-        if len(self.get_legal_actions()) == 0:
+        if self.cells[-1] != 0:
+            return int(self.cells[-1])
+        if self.reserves[self.turn] <= 0 or not self.legal:
             return -self.turn
 
     def get_first_person_result(self):
@@ -215,18 +386,8 @@ class PylosGame:
     def swap_result(result):
         return -result
 
-    def to_observation(self):
-        obs = []
-        for lvl, size in enumerate(self.LEVEL_SIZES):
-            layer = self.board[lvl]
-            for r in range(size):
-                for c in range(size):
-                    cell = layer[r, c]
-                    if cell == self.turn:
-                        obs.append(1.0)
-                    elif cell == -self.turn:
-                        obs.append(-1.0)
-                    else:
-                        obs.append(0.0)
-        return np.array(obs, dtype=np.float32)
+    def to_array_state(self):
+        return np.concatenate([self.cells, [self.turn, self.reserves[1], self.reserves[-1]]]).astype(np.int64)
 
+    def to_observation(self):
+        return (self.cells * self.turn).astype(np.float32)
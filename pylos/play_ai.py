@@ -73,6 +73,17 @@ def main():
         default=32,
         help="Number of MCTS simulations for the AI",
     )
+    parser.add_argument(
+        "--time-budget-ms",
+        type=float,
+        default=None,
+        help="Think for this many milliseconds per move, without limiting the number of simulations",
+    )
+    parser.add_argument(
+        "--early-stop",
+        action="store_true",
+        help="Stop searching once the best move can't change anymore",
+    )
     parser.add_argument(
         "--first",
         action="store_true",
@@ -85,6 +96,7 @@ def main():
     model = LinearNetwork(game.observation_shape, game.action_space)
     model.load_state_dict(torch.load(args.model, map_location=model.device))
     agent = AlphaZeroAgent(model)
+    search_iterations = None if args.time_budget_ms else args.search
 
     human_turn = 1 if args.first else -1
 
@@ -139,7 +151,14 @@ def main():
                 print(f"AI raises: {sl},{sr},{sc} -> {dl},{dr},{dc}")
                 game.raise_piece(sl, sr, sc, dl, dr, dc)
             else:
-                action = play(game, agent, args.search, c_puct=1.5)
+                action = play(
+                    game,
+                    agent,
+                    search_iterations,
+                    c_puct=1.5,
+                    time_budget_ms=args.time_budget_ms,
+                    early_stop=args.early_stop,
+                )
                 lvl, r, c = game.index_to_coords[action]
                 print(f"AI plays: {lvl},{r},{c}")
                 game.place(lvl, r, c)
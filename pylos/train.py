@@ -8,6 +8,7 @@ import sys
 sys.path.append(os.getcwd())
 from models import LinearNetwork  # noqa: E402
 from agents import AlphaZeroAgentTrainer  # noqa: E402
+from distributed import train_distributed  # noqa: E402
 from game import PylosGame
 
 OUT_DIR = "pylos/out"
@@ -17,11 +18,19 @@ SELFPLAY_GAMES_PER_SAVE = SELFPLAY_GAMES // 4
 BATCH_SIZE = 64
 SEARCH_ITERATIONS = 16
 MAX_REPLAY_BUFFER_SIZE = BATCH_SIZE * 4
+PERSISTENT_REPLAY_BUFFER = False  # keep the replay buffer on disk in OUT_DIR, to resume it after a restart
+COMPACT_REPLAY_BUFFER = False  # pack the observations in 2 bits per cell and the visits distributions in float16
+PRIORITIZED_REPLAY = False  # train more often on the samples with a high loss
+DEDUPLICATE_REPLAY = False  # store every position once, averaging the targets of its occurrences
+SYMMETRIES = False  # train on a random rotation or reflection of every sampled position
 TRAINING_EPOCHS = 3
+PREFETCH_BATCHES = 0  # batches sampled ahead of the training step in a background thread, set to 0 to disable
 LEARNING_RATE = 1e-3
 WEIGHT_DECAY = 1e-4
 C_PUCT = 1.5
 DIRICHLET_ALPHA = 0.3  # set to None to disable
+GUMBEL = False  # Gumbel root selection, which replaces the dirichlet noise
+NUM_ACTORS = 0  # self-play processes feeding this one, set to 0 to play and train in this process
 WANDB_LOG = True
 WANDB_PROJECT_NAME = "tinyalphazero-pylos"
 WANDB_RUN_NAME = "run" + datetime.now().strftime("%Y%m%d-%H%M%S")
@@ -32,7 +41,19 @@ if __name__ == "__main__":
     model = LinearNetwork(game.observation_shape, game.action_space)
     optimizer = torch.optim.AdamW(model.parameters(), lr=LEARNING_RATE, weight_decay=WEIGHT_DECAY)
 
-    agent = AlphaZeroAgentTrainer(model, optimizer, MAX_REPLAY_BUFFER_SIZE)
+    replay_buffer_path = f"{OUT_DIR}/replay_buffer" if PERSISTENT_REPLAY_BUFFER else None
+    symmetries = game.SYMMETRIES if SYMMETRIES else None
+    agent = AlphaZeroAgentTrainer(
+        model,
+        optimizer,
+        MAX_REPLAY_BUFFER_SIZE,
+        replay_buffer_path=replay_buffer_path,
+        symmetries=symmetries,
+        compact_replay_buffer=COMPACT_REPLAY_BUFFER,
+        prioritized_replay=PRIORITIZED_REPLAY,
+        deduplicate_replay=DEDUPLICATE_REPLAY,
+        prefetch_batches=PREFETCH_BATCHES,
+    )
 
     if INIT_FROM_CHECKPOINT:
         agent.load_training_state(f"{OUT_DIR}/model.pth", f"{OUT_DIR}/optimizer.pth")
@@ -43,13 +64,21 @@ if __name__ == "__main__":
     os.makedirs(OUT_DIR, exist_ok=True)
     print("Starting training")
 
-    for i in tqdm(range(SELFPLAY_GAMES)):
-        game.reset()
-
-        values_losses, policies_losses = agent.train_step(
-            game, SEARCH_ITERATIONS, BATCH_SIZE, TRAINING_EPOCHS, c_puct=C_PUCT, dirichlet_alpha=DIRICHLET_ALPHA
+    selfplay_kwargs = {"c_puct": C_PUCT, "dirichlet_alpha": DIRICHLET_ALPHA, "gumbel": GUMBEL}
+    if NUM_ACTORS > 0:
+        train_steps = train_distributed(
+            agent, game, NUM_ACTORS, SELFPLAY_GAMES, SEARCH_ITERATIONS, BATCH_SIZE, TRAINING_EPOCHS, **selfplay_kwargs
         )
 
+    for i in tqdm(range(SELFPLAY_GAMES)):
+        if NUM_ACTORS > 0:
+            values_losses, policies_losses = next(train_steps)
+        else:
+            game.reset()
+            values_losses, policies_losses = agent.train_step(
+                game, SEARCH_ITERATIONS, BATCH_SIZE, TRAINING_EPOCHS, **selfplay_kwargs
+            )
+
         if WANDB_LOG:
             for values_loss, policies_loss in zip(values_losses, policies_losses):
                 wandb.log({"values_loss": values_loss, "policies_loss": policies_loss})
@@ -58,6 +87,10 @@ if __name__ == "__main__":
             print("Saving training state")
             agent.save_training_state(f"{OUT_DIR}/model.pth", f"{OUT_DIR}/optimizer.pth")
 
+    if NUM_ACTORS > 0:
+        # stops the actors
+        train_steps.close()
+
     if WANDB_LOG:
         wandb_run.finish()
 
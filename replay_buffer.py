@@ -1,24 +1,342 @@
-from collections import deque
+import json
+import os
+import threading
 import numpy as np
 
+# the cells of compact observations take 2 bits each, so 4 of them fit in a byte
+CELLS_PER_BYTE = 4
+PACKING_SHIFTS = np.arange(0, 8, 8 // CELLS_PER_BYTE, dtype=np.uint8)
+
+
+def pack_observations(observations):
+  # the cells -1, 0 and 1 are stored as 0, 1 and 2. The last byte of each row is padded
+  cells = (observations.reshape(len(observations), -1) + 1).astype(np.uint8)
+  cells = np.pad(cells, ((0, 0), (0, -cells.shape[1] % CELLS_PER_BYTE)))
+  return np.bitwise_or.reduce(cells.reshape(len(cells), -1, CELLS_PER_BYTE) << PACKING_SHIFTS, axis=2)
+
+
+def unpack_observations(packed, num_cells):
+  # returns the flattened observations as int8
+  cells = (packed[:, :, None] >> PACKING_SHIFTS) & 3
+  return cells.reshape(len(packed), -1)[:, :num_cells].astype(np.int8) - 1
+
+
+class SumTree:
+  # complete binary tree whose leaves hold the priorities of the samples and every other node the sum of its two
+  # children, so that drawing a sample in proportion to its priority and updating a priority both take O(log n).
+  # Node 1 is the root and the children of node i are 2i and 2i + 1. Batches are walked level by level, all at once
+  def __init__(self, size):
+    self.leaves = 1 << max(size - 1, 1).bit_length()
+    self.nodes = np.zeros(2 * self.leaves)
+
+  @property
+  def total(self):
+    return self.nodes[1]
+
+  def get(self, indices):
+    return self.nodes[indices + self.leaves]
+
+  def update(self, indices, priorities):
+    nodes = indices + self.leaves
+    self.nodes[nodes] = priorities
+    while nodes[0] > 1:
+      nodes = nodes // 2
+      self.nodes[nodes] = self.nodes[2 * nodes] + self.nodes[2 * nodes + 1]
+
+  def find(self, values):
+    # the index of the leaf where each cumulative priority in values falls
+    nodes = np.ones(len(values), dtype=np.int64)
+    while nodes[0] < self.leaves:
+      left_sums = self.nodes[2 * nodes]
+      right = values >= left_sums
+      values = np.where(right, values - left_sums, values)
+      nodes = 2 * nodes + right
+    return nodes - self.leaves
+
 
 class ReplayBuffer:
-  def __init__(self, max_size):
-    self.observations = deque(maxlen=max_size)
-    self.actions_dist = deque(maxlen=max_size)
-    self.results = deque(maxlen=max_size)
+  # ring buffer of preallocated, contiguous arrays, where new samples overwrite the oldest ones. Without the
+  # observation shape and the action space, the arrays are allocated when the first sample is added. With the
+  # symmetries of a game, every sampled position is replaced by one of its symmetric positions at random. A compact
+  # buffer packs the cells of the observations, which must all be -1, 0 or 1, in 2 bits each and keeps the actions
+  # distributions as float16, decoding them to float32 when they're sampled. A prioritized buffer can also draw the
+  # samples in proportion to their loss raised to alpha, correcting the bias with importance sampling weights
+  # raised to beta (see sample_prioritized and update_priorities). A deduplicating buffer keeps a single entry for
+  # every position, whose targets are the averages of all of its occurrences, and counts them
+  FIELDS = ("observations", "actions_dist", "results")
+  # keeps the priority of the samples with no loss above zero
+  PRIORITY_EPSILON = 1e-3
+
+  def __init__(
+    self,
+    max_size,
+    observation_shape=None,
+    action_space=None,
+    symmetries=None,
+    compact=False,
+    prioritized=False,
+    alpha=0.6,
+    beta=0.4,
+    deduplicate=False,
+  ):
+    self.max_size = max_size
+    self.symmetries = symmetries
+    self.compact = compact
+    self.deduplicate = deduplicate
+    self.fields = self.FIELDS + (("counts",) if deduplicate else ())
+    # the slot of every stored position, by the bytes of its stored observation, and the other way around
+    self.index = {}
+    self.keys = [None] * max_size if deduplicate else None
+    self.sum_tree = SumTree(max_size) if prioritized else None
+    # priorities can be updated while another thread samples the next batch or adds samples
+    self.priorities_lock = threading.Lock()
+    self.alpha = alpha
+    self.beta = beta
+    # new samples get the highest priority seen so far, so that they're drawn at least once
+    self.max_priority = 1.0
+    self.size = 0
+    # index of the next sample to write
+    self.cursor = 0
+    self.rng = np.random.default_rng()
+    self.observations = None
+    # sample() writes its batches into these, instead of allocating new arrays every time
+    self.batch = None
+    if observation_shape is not None and action_space is not None:
+      self._allocate(observation_shape, action_space)
 
   def __len__(self):
-    return len(self.observations)
+    return self.size
+
+  def _layout(self, observation_shape, action_space):
+    # the shape and the dtype of every field
+    if self.compact:
+      packed_size = -(-int(np.prod(observation_shape)) // CELLS_PER_BYTE)
+      layout = (
+        ((self.max_size, packed_size), np.uint8),
+        ((self.max_size, action_space), np.float16),
+        ((self.max_size,), np.float32),
+      )
+    else:
+      layout = (
+        ((self.max_size, *observation_shape), np.float32),
+        ((self.max_size, action_space), np.float32),
+        ((self.max_size,), np.float32),
+      )
+    return layout + ((((self.max_size,), np.float32),) if self.deduplicate else ())
+
+  def _allocate(self, observation_shape, action_space):
+    self.observation_shape = tuple(observation_shape)
+    for name, (shape, dtype) in zip(self.fields, self._layout(observation_shape, action_space)):
+      setattr(self, name, np.zeros(shape, dtype=dtype))
 
   def add_sample(self, observation, actions_dist, result):
-    self.observations.append(observation)
-    self.actions_dist.append(actions_dist)
-    self.results.append(result)
-
-  def sample(self, batch_size):
-    indices = np.random.choice(len(self), batch_size, replace=False)
-    observations = np.array([self.observations[i] for i in indices], dtype=np.float32)
-    actions_dist = np.array([self.actions_dist[i] for i in indices], dtype=np.float32)
-    results = np.array([self.results[i] for i in indices], dtype=np.float32)
-    return observations, actions_dist, results
+    self.add_samples(np.expand_dims(observation, 0), np.expand_dims(actions_dist, 0), np.array([result]))
+
+  def add_samples(self, observations, actions_dist, results):
+    # writes a whole trajectory with at most two slice assignments, wrapping around the end of the arrays
+    if self.observations is None:
+      self._allocate(np.shape(observations)[1:], np.shape(actions_dist)[1])
+    if self.compact:
+      if not np.isin(observations, (-1, 0, 1)).all():
+        raise ValueError("A compact replay buffer can only store observations made of -1, 0 and 1")
+      observations = pack_observations(observations)
+    if self.deduplicate:
+      self._add_deduplicated(observations, actions_dist, results)
+      return
+    count = len(results)
+    if count > self.max_size:
+      observations, actions_dist, results = (
+        observations[-self.max_size :],
+        actions_dist[-self.max_size :],
+        results[-self.max_size :],
+      )
+      count = self.max_size
+    if self.sum_tree is not None:
+      with self.priorities_lock:
+        self.sum_tree.update(np.arange(self.cursor, self.cursor + count) % self.max_size, self.max_priority)
+    first = min(count, self.max_size - self.cursor)
+    for array, samples in (
+      (self.observations, observations),
+      (self.actions_dist, actions_dist),
+      (self.results, results),
+    ):
+      array[self.cursor : self.cursor + first] = samples[:first]
+      array[: count - first] = samples[first:]
+    self.cursor = (self.cursor + count) % self.max_size
+    self.size = min(self.size + count, self.max_size)
+
+  def _add_deduplicated(self, observations, actions_dist, results):
+    # a position that is already stored is merged into its entry, updating the running averages of its targets.
+    # A new one takes the slot at the cursor, and the position it evicts is forgotten
+    for observation, sample_actions_dist, result in zip(observations, actions_dist, results):
+      key = observation.tobytes()
+      i = self.index.get(key)
+      if i is None:
+        i = self.cursor
+        if self.keys[i] is not None:
+          del self.index[self.keys[i]]
+        self.index[key], self.keys[i] = i, key
+        self.observations[i] = observation
+        self.actions_dist[i] = sample_actions_dist
+        self.results[i] = result
+        self.counts[i] = 1
+        self.cursor = (self.cursor + 1) % self.max_size
+        self.size = min(self.size + 1, self.max_size)
+      else:
+        self.counts[i] += 1
+        self.actions_dist[i] += (sample_actions_dist - self.actions_dist[i]) / self.counts[i]
+        self.results[i] += (result - self.results[i]) / self.counts[i]
+      if self.sum_tree is not None:
+        # new targets, new loss
+        with self.priorities_lock:
+          self.sum_tree.update(np.array([i]), self.max_priority)
+
+  def _index_positions(self):
+    for i in self._stored_indices():
+      key = self.observations[i].tobytes()
+      self.index[key], self.keys[i] = i, key
+
+  def _stored_indices(self):
+    # the samples are the size slots before the cursor, which are all of them once the buffer is full
+    return (self.cursor - self.size + np.arange(self.size)) % self.max_size
+
+  @property
+  def prioritized(self):
+    return self.sum_tree is not None
+
+  def sample(self, batch_size, out=None):
+    # the returned arrays are overwritten by the next call, unless the batch is written into the arrays in out
+    indices = (self.cursor - self.size + self.rng.choice(self.size, batch_size, replace=False)) % self.max_size
+    return self._gather(indices, out)
+
+  def sample_prioritized(self, batch_size, out=None):
+    # draws one sample from each of batch_size equal slices of the total priority. Returns the batch, the indices of
+    # its samples, to update their priorities, and their importance sampling weights, normalized by the largest
+    with self.priorities_lock:
+      total = self.sum_tree.total
+      values = (np.arange(batch_size) + self.rng.random(batch_size)) * (total / batch_size)
+      indices = self.sum_tree.find(values)
+      # rounding can push a value past the last stored sample, onto a slot with no priority
+      indices = np.where(self.sum_tree.get(indices) > 0, indices, (self.cursor - 1) % self.max_size)
+      weights = (self.size * self.sum_tree.get(indices) / total) ** -self.beta
+    return self._gather(indices, out), indices, (weights / weights.max()).astype(np.float32)
+
+  def sample_for_training(self, batch_size, out=None):
+    # the batch followed by the indices and the importance sampling weights of its samples, both None unless the
+    # buffer is prioritized
+    if self.prioritized:
+      batch, indices, weights = self.sample_prioritized(batch_size, out)
+      return (*batch, indices, weights)
+    return (*self.sample(batch_size, out), None, None)
+
+  def update_priorities(self, indices, losses):
+    priorities = (np.abs(losses) + self.PRIORITY_EPSILON) ** self.alpha
+    with self.priorities_lock:
+      self.sum_tree.update(indices, priorities)
+      self.max_priority = max(self.max_priority, priorities.max())
+
+  def batch_shapes(self, batch_size):
+    return (batch_size, *self.observation_shape), (batch_size, self.actions_dist.shape[1]), (batch_size,)
+
+  def _gather(self, indices, out=None):
+    batch_size = len(indices)
+    if out is None:
+      if self.batch is None or len(self.batch[2]) != batch_size:
+        self.batch = tuple(np.empty(shape, dtype=np.float32) for shape in self.batch_shapes(batch_size))
+      out = self.batch
+    observations_out, actions_dist_out, results_out = out
+    np.take(self.results, indices, out=results_out)
+    if self.symmetries is not None:
+      symmetries = self.rng.integers(len(self.symmetries[0]), size=batch_size)
+    if self.compact:
+      # the rows are decoded before the symmetries permute their cells
+      observations = unpack_observations(np.take(self.observations, indices, axis=0), observations_out[0].size)
+      actions_dist = np.take(self.actions_dist, indices, axis=0)
+      if self.symmetries is not None:
+        observations = np.take_along_axis(observations, self.symmetries[0][symmetries], axis=1)
+        actions_dist = np.take_along_axis(actions_dist, self.symmetries[1][symmetries], axis=1)
+      observations_out.reshape(batch_size, -1)[:] = observations
+      actions_dist_out[:] = actions_dist
+    elif self.symmetries is None:
+      np.take(self.observations, indices, axis=0, out=observations_out)
+      np.take(self.actions_dist, indices, axis=0, out=actions_dist_out)
+    else:
+      # the symmetry is applied by the gather itself: each sample takes the flat indices of its permuted cells
+      for array, array_out, permutations in zip(
+        (self.observations, self.actions_dist), (observations_out, actions_dist_out), self.symmetries
+      ):
+        flat_indices = indices[:, None] * permutations.shape[1] + permutations[symmetries]
+        np.take(array.reshape(-1), flat_indices, out=array_out.reshape(batch_size, -1))
+    return out
+
+
+class PersistentReplayBuffer(ReplayBuffer):
+  # replay buffer stored in memory-mapped .npy files inside directory, so that it can be larger than the memory and
+  # survive restarts: an existing buffer is resumed where it was left. The write pointer is saved, atomically, only
+  # after the samples it covers have been flushed to disk, and the slots a trajectory overwrites are dropped from the
+  # saved state before they're written. So a crash can lose the last trajectory, and the samples it was replacing,
+  # but never resumes a slot written in part. The averaged targets of a deduplicating buffer are updated in place
+  # though, so they can miss part of the last trajectory. The priorities aren't saved: the resumed samples all get
+  # the same one
+  def __init__(self, max_size, directory, observation_shape=None, action_space=None, **kwargs):
+    self.directory = directory
+    self.state_path = os.path.join(directory, "state.json")
+    os.makedirs(directory, exist_ok=True)
+    super().__init__(max_size, observation_shape, action_space, **kwargs)
+    if self.observations is None and os.path.exists(self.state_path):
+      self._open()
+
+  def _allocate(self, observation_shape, action_space):
+    if os.path.exists(self.state_path):
+      self._open()
+      if self.observation_shape != tuple(observation_shape) or self.actions_dist.shape[1] != action_space:
+        raise ValueError(f"The replay buffer in {self.directory} holds samples of a different shape")
+      return
+    self.observation_shape = tuple(observation_shape)
+    for name, (shape, dtype) in zip(self.fields, self._layout(observation_shape, action_space)):
+      setattr(self, name, np.lib.format.open_memmap(self._path(name), mode="w+", dtype=dtype, shape=shape))
+    self.flush()
+
+  def _open(self):
+    if os.path.exists(self._path("counts")) != self.deduplicate:
+      raise ValueError(f"The replay buffer in {self.directory} is {'not ' if self.deduplicate else ''}deduplicated")
+    for name in self.fields:
+      setattr(self, name, np.lib.format.open_memmap(self._path(name), mode="r+"))
+    if len(self.results) != self.max_size:
+      raise ValueError(f"The replay buffer in {self.directory} holds {len(self.results)} samples, not {self.max_size}")
+    if (self.observations.dtype == np.uint8) != self.compact:
+      raise ValueError(f"The replay buffer in {self.directory} is {'not ' if self.compact else ''}compact")
+    with open(self.state_path) as f:
+      state = json.load(f)
+    self.size, self.cursor = state["size"], state["cursor"]
+    # compact observations are stored flattened, so their shape is kept in the state
+    self.observation_shape = tuple(state.get("observation_shape", self.observations.shape[1:]))
+    if self.sum_tree is not None and self.size > 0:
+      self.sum_tree.update(self._stored_indices(), self.max_priority)
+    if self.deduplicate:
+      self._index_positions()
+
+  def _path(self, name):
+    return os.path.join(self.directory, f"{name}.npy")
+
+  def add_samples(self, observations, actions_dist, results):
+    count = min(len(results), self.max_size)
+    if self.observations is not None and self.size + count > self.max_size:
+      # the pages of the memory maps can reach the disk at any time, so the saved state must stop covering the
+      # slots after the cursor before they're overwritten
+      self._save_state(self.max_size - count)
+    super().add_samples(observations, actions_dist, results)
+    self.flush()
+
+  def flush(self):
+    for name in self.fields:
+      getattr(self, name).flush()
+    self._save_state(self.size)
+
+  def _save_state(self, size):
+    temporary_path = self.state_path + ".tmp"
+    with open(temporary_path, "w") as f:
+      json.dump({"size": size, "cursor": self.cursor, "observation_shape": self.observation_shape}, f)
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(temporary_path, self.state_path)
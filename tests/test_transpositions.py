@@ -0,0 +1,53 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(os.getcwd())
+from mcts import TranspositionTable, search  # noqa: E402
+from tictactoe.one_dim.game import TicTacToe  # noqa: E402
+
+
+def value_fn(game):
+  return 0.0
+
+
+def policy_fn(game):
+  return np.full(game.action_space, 1 / game.action_space, dtype=np.float32)
+
+
+def batch_evaluate_fn(observations):
+  return np.full((len(observations), 9), 1 / 9, dtype=np.float32), np.zeros(len(observations), dtype=np.float32)
+
+
+@pytest.mark.parametrize("backend", ["nodes", "array"])
+@pytest.mark.parametrize("batch_size", [1, 4])
+def test_entries_share_terminal_results(backend, batch_size):
+  # the network always says 0, so only the terminal results can move the values away from it. The positions one
+  # move from the root can't be reached by any other path, so their entries must match the root children exactly
+  game = TicTacToe()
+  game.step(0)
+  game.step(4)
+  game.step(8)
+  game.step(1)
+  transpositions = TranspositionTable()
+  tree = search(
+    game,
+    value_fn,
+    policy_fn,
+    400,
+    backend=backend,
+    batch_size=batch_size,
+    batch_evaluate_fn=batch_evaluate_fn,
+    transpositions=transpositions,
+  )
+  assert transpositions.entries[game.position_hash].visits == 400
+  for action, visits, value in zip(tree.children_actions, tree.children_visits, tree.children_values):
+    game.step(action)
+    entry = transpositions.entries[game.position_hash]
+    game.undo_last_action()
+    assert entry.visits == visits
+    # the entries hold the value of the player to move, the tree children the value of the player who moved
+    assert entry.value == pytest.approx(-value, abs=1e-5)
+  assert np.abs(tree.children_values).max() > 0
@@ -1,7 +1,65 @@
 import numpy as np
+from numba import njit
+
+WIN_LINES = np.array([(0, 1, 2), (3, 4, 5), (6, 7, 8), (0, 3, 6), (1, 4, 7), (2, 5, 8), (0, 4, 8), (2, 4, 6)])
+# the 4 rotations of the board and of its transpose, as index permutations: the symmetric cells are cells[permutation]
+BOARD_SYMMETRIES = np.array(
+  [np.rot90(grid, k).ravel() for grid in (np.arange(9).reshape(3, 3), np.arange(9).reshape(3, 3).T) for k in range(4)]
+)
+
+# the cells of every winning line as a bitmask, and for every cell the masks of the lines going through it
+WIN_MASKS = [sum(1 << cell for cell in line) for line in WIN_LINES.tolist()]
+CELL_WIN_MASKS = [[mask for mask in WIN_MASKS if mask >> cell & 1] for cell in range(9)]
+FULL_BOARD = (1 << 9) - 1
+
+
+# array state: the 9 cells followed by the player to move
+@njit(cache=True)
+def array_legal_actions(state, out):
+  n = 0
+  for i in range(9):
+    if state[i] == 0:
+      out[n] = i
+      n += 1
+  return n
+
+
+@njit(cache=True)
+def array_step(state, action):
+  state[action] = state[9]
+  state[9] = -state[9]
+
+
+@njit(cache=True)
+def array_undo(state, action):
+  state[action] = 0
+  state[9] = -state[9]
+
+
+@njit(cache=True)
+def array_first_person_result(state):
+  for x, y, z in WIN_LINES:
+    if state[x] != 0 and state[x] == state[y] == state[z]:
+      return float(state[x] * state[9])
+  for i in range(9):
+    if state[i] == 0:
+      return np.nan
+  return 0.0
+
+
+@njit(cache=True)
+def array_observation(state, out):
+  for i in range(9):
+    out[i] = state[i] * state[9]
 
 
 class TicTacToe:
+  # one random key for every (cell, player) pair, xored in and out of the position hash as stones come and go
+  ZOBRIST_KEYS = np.random.default_rng(0).integers(1, 2**63, size=(9, 2)).tolist()
+  ARRAY_FUNCTIONS = (array_legal_actions, array_step, array_undo, array_first_person_result, array_observation)
+  # the permutations of the (flattened) observation and of the actions under every symmetry of the board
+  SYMMETRIES = (BOARD_SYMMETRIES, BOARD_SYMMETRIES)
+
   def __init__(self):
     self.reset()
 
@@ -12,6 +70,7 @@ class TicTacToe:
     self.state = [0] * 9
     self.actions = []
     self.turn = 1
+    self.position_hash = 0
 
   def __str__(self):
     return "\n".join(["  ".join([str(x) for x in self.state[i : i + 3]]) for i in range(0, 9, 3)])
@@ -24,11 +83,14 @@ class TicTacToe:
       raise ValueError(f"Action {action} is illegal")
     self.state[action] = self.turn
     self.actions.append(action)
+    self.position_hash ^= self.ZOBRIST_KEYS[action][(1 - self.turn) // 2]
     self.turn *= -1
 
   def undo_last_action(self):
-    self.state[self.actions.pop()] = 0
+    action = self.actions.pop()
+    self.state[action] = 0
     self.turn *= -1
+    self.position_hash ^= self.ZOBRIST_KEYS[action][(1 - self.turn) // 2]
 
   def get_result(self):
     if len(self.actions) < 5:
@@ -48,6 +110,9 @@ class TicTacToe:
   def swap_result(result):
     return -result
 
+  def to_array_state(self):
+    return np.array(self.state + [self.turn], dtype=np.int64)
+
   def to_observation(self):
     obs = np.zeros(9, dtype=np.float32)
     for i, x in enumerate(self.state):
@@ -56,3 +121,65 @@ class TicTacToe:
       elif x == -self.turn:
         obs[i] = -1
     return obs
+
+
+class BitboardTicTacToe(TicTacToe):
+  # the same game, with the stones of each player kept as the bits of an integer. Only the lines through the last
+  # stone are checked for a win, a draw is a full board, and the observations of both players are updated in place
+  # by step and undo_last_action instead of being rebuilt
+  def reset(self):
+    # the stones of the first and of the second player, and the observation each of them sees
+    self.boards = [0, 0]
+    self.observations = [np.zeros(9, dtype=np.float32), np.zeros(9, dtype=np.float32)]
+    self.actions = []
+    self.turn = 1
+    self.position_hash = 0
+
+  @property
+  def state(self):
+    return [(self.boards[0] >> i & 1) - (self.boards[1] >> i & 1) for i in range(9)]
+
+  def get_legal_actions(self):
+    empty = ~(self.boards[0] | self.boards[1]) & FULL_BOARD
+    actions = []
+    while empty:
+      action = (empty & -empty).bit_length() - 1
+      actions.append(action)
+      empty ^= 1 << action
+    return actions
+
+  def step(self, action):
+    # the array backends play NumPy integers, which would turn the boards into fixed-size integers
+    bit = 1 << int(action)
+    if (self.boards[0] | self.boards[1]) & bit:
+      raise ValueError(f"Action {action} is illegal")
+    player = (1 - self.turn) // 2
+    self.boards[player] |= bit
+    self.observations[player][action] = 1
+    self.observations[1 - player][action] = -1
+    self.actions.append(action)
+    self.position_hash ^= self.ZOBRIST_KEYS[action][player]
+    self.turn = -self.turn
+
+  def undo_last_action(self):
+    action = self.actions.pop()
+    self.turn = -self.turn
+    player = (1 - self.turn) // 2
+    self.boards[player] ^= 1 << int(action)
+    self.observations[0][action] = 0
+    self.observations[1][action] = 0
+    self.position_hash ^= self.ZOBRIST_KEYS[action][player]
+
+  def get_result(self):
+    if len(self.actions) < 5:
+      return
+    # only the player who moved last can have just completed a line
+    board = self.boards[(1 + self.turn) // 2]
+    for mask in CELL_WIN_MASKS[self.actions[-1]]:
+      if (board & mask) == mask:
+        return -self.turn
+    if (self.boards[0] | self.boards[1]) == FULL_BOARD:
+      return 0
+
+  def to_observation(self):
+    return self.observations[(1 - self.turn) // 2].copy()
@@ -12,6 +12,7 @@ from agents import AlphaZeroAgent, ClassicMCTSAgent  # noqa: E402
 from mcts import pit  # noqa: E402
 
 EVAL_GAMES = 100
+CACHE_SIZE = 10_000  # evaluations cached by the agent, enough for every reachable position
 
 if __name__ == "__main__":
   game = TicTacToe()
@@ -19,7 +20,7 @@ if __name__ == "__main__":
   model = TicTacToe2DNetwork(game.observation_shape, game.action_space)
   model.load_state_dict(torch.load(f"{OUT_DIR}/model.pth"))
 
-  agent = AlphaZeroAgent(model)
+  agent = AlphaZeroAgent(model, cache_size=CACHE_SIZE)
   agent_play_kwargs = {"search_iterations": SEARCH_ITERATIONS * 2, "c_puct": 1.0, "dirichlet_alpha": None}
 
   print(f"Playing {EVAL_GAMES} games against itself")
@@ -41,7 +42,7 @@ if __name__ == "__main__":
   print(f"Second player wins: {results[-1]}")
   print(f"Draws: {results[0]}")
 
-  classic_mcts_agent = ClassicMCTSAgent
+  classic_mcts_agent = ClassicMCTSAgent()
   classic_mcts_agent_play_kwargs = {"search_iterations": 100, "c_puct": 1.0, "dirichlet_alpha": None}
 
   print(f"Playing {EVAL_GAMES} games against classic MCTS agent (starting first)")
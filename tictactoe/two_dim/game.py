@@ -3,6 +3,7 @@ import os
 import sys
 
 sys.path.append(os.getcwd())
+from tictactoe.one_dim.game import BitboardTicTacToe as BitboardTicTacToe1D  # noqa: E402
 from tictactoe.one_dim.game import TicTacToe as TicTacToe1D  # noqa: E402
 
 
@@ -18,3 +19,8 @@ class TicTacToe(TicTacToe1D):
       elif x == -self.turn:
         obs[i // 3, i % 3] = -1
     return np.array([obs])
+
+
+class BitboardTicTacToe(BitboardTicTacToe1D):
+  def to_observation(self):
+    return super().to_observation().reshape(1, 3, 3)